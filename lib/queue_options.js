@@ -0,0 +1,52 @@
+const fs = require("fs");
+const path = require("path");
+
+const CONFIG_PATH = path.join(__dirname, "..", "config.json");
+
+// Queue options from the `queues` section of config.json, if the queue is defined there.
+// Mirrors the arguments of `RabbitMQ.declare_queue`, so that the plugins and the
+// workers declare the queue alike.
+function get_queue_options(queue, default_options) {
+    let queue_config;
+    try {
+        queue_config = (JSON.parse(fs.readFileSync(CONFIG_PATH, "utf8")).queues || {})[
+            queue
+        ];
+    } catch (error) {
+        return default_options;
+    }
+
+    if (!queue_config) {
+        return default_options;
+    }
+
+    const queue_type = queue_config.type || "classic";
+    if (queue_config.max_priority > 0 && queue_type !== "classic") {
+        // The broker would close the channel with an opaque PRECONDITION_FAILED.
+        throw new Error(
+            `Queue ${queue}: max_priority is only supported by classic queues, not ${queue_type} queues.`
+        );
+    }
+
+    const args = {};
+    if (queue_config.max_priority > 0) {
+        args["x-max-priority"] = queue_config.max_priority;
+    }
+    if (queue_type !== "classic") {
+        args["x-queue-type"] = queue_type;
+    }
+    if (queue_config.max_age) {
+        args["x-max-age"] = queue_config.max_age;
+    }
+    if (queue_config.max_length_bytes) {
+        args["x-max-length-bytes"] = queue_config.max_length_bytes;
+    }
+    if (queue_config.stream_max_segment_size_bytes) {
+        args["x-stream-max-segment-size-bytes"] =
+            queue_config.stream_max_segment_size_bytes;
+    }
+
+    return { durable: queue_config.durable !== false, arguments: args };
+}
+
+module.exports = { get_queue_options };
@@ -1,6 +1,11 @@
 import sys
 import json
 from rabbitmq import RabbitMQ
+from smtp import SMTPConnectionPool, configure_dkim_signing
+from envelope import CONTENT_TYPE
+from size_class import route_by_size
+from shard import get_shard_queue, get_shard_queues
+from fair_queue import get_tenant, get_tenant_queue, get_tenant_queues
 from utils import get_attr, replace_env_vars
 
 
@@ -18,9 +23,67 @@ def run(config: dict, queue: str, worker_id: str) -> None:
     consumer_config = config["consumers"][queue]
     auto_ack = consumer_config["auto_ack"]
     prefetch_count = consumer_config["prefetch_count"]
+    shutdown_timeout = float(consumer_config.get("shutdown_timeout", 30))
+    concurrency = consumer_config.get("concurrency", 1)
     callback = get_attr("callback", consumer_config["callback"])
+    configure_dkim_signing(concurrency, get_worker_count(config))
     rabbitmq = get_rabbitmq_connection(rabbitmq_config)
-    rabbitmq.consume(queue, callback, auto_ack, prefetch_count)
+
+    queue_config = queues_config.get(queue, {})
+    # Sharded workers consume their shard along with the queue itself, which still
+    # receives the messages of publishers that don't publish to the sharded exchange.
+    source_queues = [queue]
+    if shards := queue_config.get("shards"):
+        source_queues.insert(0, get_shard_queue(queue, int(worker_id), shards))
+
+    if size_classes := queue_config.get("size_classes"):
+        # Large payloads are handed over to the workers of their size class,
+        # so that they don't hold up the small ones prefetched behind them.
+        callback = route_by_size(callback, size_classes)
+        rabbitmq.confirm_delivery()
+
+    try:
+        if fair_queueing := queue_config.get("fair_queueing"):
+            # Every worker moves messages from the shared queue to the tenant sub-queues,
+            # so that a single tenant's backlog cannot hold up the other tenants.
+            for source_queue in source_queues:
+                rabbitmq.route(
+                    source_queue,
+                    lambda properties, body: get_tenant_queue(
+                        queue, get_tenant(properties, body, CONTENT_TYPE), fair_queueing
+                    ),
+                    prefetch_count,
+                )
+            rabbitmq.consume_fair(
+                get_tenant_queues(queue, fair_queueing),
+                callback,
+                auto_ack,
+                prefetch_count,
+                shutdown_timeout,
+                concurrency,
+            )
+        else:
+            rabbitmq.consume(
+                source_queues,
+                callback,
+                auto_ack,
+                prefetch_count,
+                shutdown_timeout,
+                concurrency,
+                consumer_config.get("stream_offset"),
+            )
+    finally:
+        # Say QUIT to Haraka on the pooled connections before the worker exits.
+        SMTPConnectionPool().close_connections()
+
+
+def get_worker_count(config: dict) -> int:
+    """Returns the number of workers of all consumers, as started by the Procfile."""
+
+    return sum(
+        max(consumer_config["workers"], config["queues"].get(queue, {}).get("shards", 1))
+        for queue, consumer_config in config["consumers"].items()
+    )
 
 
 def get_rabbitmq_connection(rabbitmq_config: dict) -> RabbitMQ:
@@ -39,11 +102,45 @@ def declare_queues(rabbitmq: RabbitMQ, queues_config: dict[str, dict]) -> None:
     """Declares the queues in RabbitMQ."""
 
     for queue, queue_config in queues_config.items():
-        rabbitmq.declare_queue(
-            queue=queue,
-            max_priority=queue_config.get("max_priority", 0),
-            durable=queue_config["durable"],
-        )
+        queues = [queue]
+        if fair_queueing := queue_config.get("fair_queueing"):
+            queues.extend(get_tenant_queues(queue, fair_queueing))
+        if size_classes := queue_config.get("size_classes"):
+            queues.extend(size_classes)
+
+        shard_queues = []
+        if shards := queue_config.get("shards"):
+            shard_queues = get_shard_queues(queue, shards)
+            queues.extend(shard_queues)
+
+        for name in queues:
+            rabbitmq.declare_queue(
+                queue=name,
+                max_priority=queue_config.get("max_priority", 0),
+                durable=queue_config["durable"],
+                queue_type=queue_config.get("type", "classic"),
+                max_age=queue_config.get("max_age"),
+                max_length_bytes=queue_config.get("max_length_bytes"),
+                stream_max_segment_size_bytes=queue_config.get(
+                    "stream_max_segment_size_bytes"
+                ),
+                # Spreads the shards over the cluster nodes, instead of placing
+                # them all on the node the declaring worker is connected to.
+                leader_locator=(
+                    queue_config.get("shard_leader_locator", "balanced")
+                    if name in shard_queues
+                    else None
+                ),
+            )
+
+        if shard_queues:
+            # Requires the rabbitmq_consistent_hash_exchange plugin on the broker.
+            rabbitmq.declare_exchange(
+                queue, "x-consistent-hash", durable=queue_config["durable"]
+            )
+            for shard_queue in shard_queues:
+                # The routing key of a consistent hash binding is the shard's weight.
+                rabbitmq.bind_queue(shard_queue, queue, routing_key="1")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,83 @@
+import os
+import json
+import time
+import struct
+import ipaddress
+from urllib.request import urlopen
+
+
+SNAPSHOT_MAGIC = b"MABL"
+SNAPSHOT_VERSION = 1
+# Magic, version, generated at (epoch seconds) and number of ranges.
+SNAPSHOT_HEADER = struct.Struct(">4sHdI")
+IPV4_MAPPED_PREFIX = 0xFFFF << 32
+
+
+def get_blacklist(host: str, timeout: int = 30) -> list[str]:
+    """Returns the blacklisted IP addresses and networks from the Frappe Mail server."""
+
+    with urlopen(
+        f"{host}/api/method/mail.api.blacklist.get_all", timeout=timeout
+    ) as response:
+        entries = json.load(response)["message"]
+
+    return [
+        entry["ip_address"] if isinstance(entry, dict) else entry for entry in entries
+    ]
+
+
+def get_ranges(networks: list[str]) -> list[tuple[int, int]]:
+    """Returns the sorted and merged address ranges of the networks, IPv4 mapped into IPv6."""
+
+    ranges = []
+    for network in networks:
+        try:
+            network = ipaddress.ip_network(network.strip(), strict=False)
+        except ValueError:
+            continue
+
+        start = int(network.network_address)
+        end = int(network.broadcast_address)
+        if network.version == 4:
+            start, end = start | IPV4_MAPPED_PREFIX, end | IPV4_MAPPED_PREFIX
+
+        ranges.append((start, end))
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def write_snapshot(
+    path: str, ranges: list[tuple[int, int]], generated_at: float | None = None
+) -> None:
+    """Atomically writes the ranges as fixed size big-endian records that can be binary searched."""
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(
+            SNAPSHOT_HEADER.pack(
+                SNAPSHOT_MAGIC,
+                SNAPSHOT_VERSION,
+                generated_at or time.time(),
+                len(ranges),
+            )
+        )
+        for start, end in ranges:
+            f.write(start.to_bytes(16, "big") + end.to_bytes(16, "big"))
+
+    os.replace(tmp_path, path)
+
+
+def update_snapshot(host: str, path: str) -> int:
+    """Syncs the blacklist into the snapshot and returns the number of ranges."""
+
+    ranges = get_ranges(get_blacklist(host))
+    write_snapshot(path, ranges)
+
+    return len(ranges)
@@ -1,5 +1,10 @@
 import json
+import time
+import pika
+import datetime
 from smtp import send_mail
+from envelope import parse_mail
+from idempotency import get_idempotency_cache
 
 
 def print_message(channel, method, properties, body) -> None:
@@ -11,8 +16,50 @@ def print_message(channel, method, properties, body) -> None:
 
 
 def sendmail(channel, method, properties, body) -> None:
-    """Sends an email."""
+    """Sends an email, acking redelivered or forwarded messages that were already sent without resending."""
+
+    mail = parse_mail(properties, body)
+    outgoing_mail = mail["outgoing_mail"]
+    idempotency_cache = get_idempotency_cache()
+
+    # Copies forwarded to sub-queues may duplicate an original whose ack was lost.
+    forwarded = bool(properties.headers and properties.headers.get("x-forwarded"))
+    if (method.redelivered or forwarded) and idempotency_cache.contains(outgoing_mail):
+        print(f"Message {outgoing_mail} was already sent, skipping redelivery.")
+    else:
+        trace = {"enqueued_at": properties.timestamp, "received_at": time.time()}
+        if refused := send_mail(mail, trace):
+            enqueue_refused_status(channel, outgoing_mail, refused)
+        idempotency_cache.add(outgoing_mail)
 
-    body = json.loads(body)
-    send_mail(body)
     channel.basic_ack(delivery_tag=method.delivery_tag)
+
+
+def enqueue_refused_status(channel, outgoing_mail: str, refused: dict) -> None:
+    """Publishes the recipients refused by Haraka as delivery statuses, like the bounces of Haraka.
+
+    Permanent (5xx) refusals are published as `rcpt_refused`, temporary ones as `rcpt_deferred`.
+    """
+
+    statuses = {}
+    for rcpt, (code, response) in refused.items():
+        hook = "rcpt_refused" if code >= 500 else "rcpt_deferred"
+        statuses.setdefault(hook, []).append(
+            {"original": rcpt, "code": code, "response": response.decode(errors="replace")}
+        )
+
+    for hook, rcpt_to in statuses.items():
+        data = {
+            "hook": hook,
+            "rcpt_to": rcpt_to,
+            "outgoing_mail": outgoing_mail,
+            "action_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }
+        channel.basic_publish(
+            exchange="",
+            routing_key="mail_agent::outgoing_mails_status",
+            body=json.dumps(data),
+            properties=pika.BasicProperties(
+                delivery_mode=pika.DeliveryMode.Persistent, timestamp=int(time.time())
+            ),
+        )
@@ -0,0 +1,83 @@
+import re
+import gzip
+import json
+import struct
+import hashlib
+from typing import Iterator
+from mail_agent.envelope import CONTENT_TYPE
+
+
+# Lengths of the JSON metadata and of the payload that follow.
+RECORD_HEADER = struct.Struct(">II")
+EMAIL_ADDRESS_PATTERN = re.compile(rb"[\w.+-]+@([\w-]+\.)+[\w-]+")
+SUBJECT_PATTERN = re.compile(rb"(?im)^(subject:)(.*(?:\r?\n[ \t].*)*)")
+
+
+class CaptureWriter:
+    def __init__(self, path: str) -> None:
+        """Opens the capture file for appending, each run is added as a new gzip member."""
+
+        self._file = gzip.open(path, "ab")
+
+    def write(self, meta: dict, body: bytes) -> None:
+        """Appends a captured message."""
+
+        # AMQP headers can hold values like decimals and timestamps that JSON lacks.
+        meta = json.dumps(meta, default=str).encode()
+        self._file.write(RECORD_HEADER.pack(len(meta), len(body)) + meta + body)
+
+    def close(self) -> None:
+        """Closes the capture file."""
+
+        self._file.close()
+
+    def __enter__(self) -> "CaptureWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def read_capture(path: str) -> Iterator[tuple[dict, bytes]]:
+    """Yields the metadata and payload of the captured messages in order."""
+
+    with gzip.open(path, "rb") as f:
+        while header := f.read(RECORD_HEADER.size):
+            meta_length, body_length = RECORD_HEADER.unpack(header)
+            yield json.loads(f.read(meta_length)), f.read(body_length)
+
+
+def anonymize_address(match: re.Match) -> bytes:
+    """Returns a stable pseudonym for the email address, keeping addresses of a domain together."""
+
+    local_part, _, domain = match.group(0).rpartition(b"@")
+    return (
+        hashlib.sha1(local_part).hexdigest()[:12].encode()
+        + b"@"
+        + hashlib.sha1(domain.lower()).hexdigest()[:12].encode()
+        + b".example"
+    )
+
+
+def anonymize(data: bytes) -> bytes:
+    """Replaces the email addresses and blanks the subjects, keeping the size and MIME structure."""
+
+    data = EMAIL_ADDRESS_PATTERN.sub(anonymize_address, data)
+    return SUBJECT_PATTERN.sub(
+        lambda match: match.group(1) + re.sub(rb"[^\s]", b"x", match.group(2)), data
+    )
+
+
+def anonymize_message(properties, body: bytes) -> tuple[dict, bytes]:
+    """Returns the anonymized AMQP headers and payload of a raw MIME or a JSON outgoing mail."""
+
+    headers = json.loads(anonymize(json.dumps(properties.headers or {}, default=str).encode()))
+    if properties.content_type == CONTENT_TYPE:
+        return headers, anonymize(body)
+
+    # The message is anonymized before encoding, as its line breaks are escaped in JSON.
+    mail = json.loads(body)
+    mail["message"] = anonymize(
+        mail["message"].encode("utf-8", "surrogateescape")
+    ).decode("utf-8", "surrogateescape")
+    return headers, anonymize(json.dumps(mail).encode())
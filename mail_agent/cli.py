@@ -1,12 +1,25 @@
 import os
+import sys
 import json
+import time
 import click
+import pika
 import distro
 import platform
+import datetime
 import subprocess
+from typing import Iterator
+from itertools import islice
+from smtplib import SMTPException
 from dotenv import load_dotenv
 from mail_agent.haraka import Haraka
 from mail_agent.rabbitmq import RabbitMQ
+from mail_agent.shard import get_shard_queues
+from mail_agent.envelope import parse_mail
+from mail_agent.blacklist import update_snapshot
+from mail_agent.latency import LatencyAggregator
+from mail_agent.fair_queue import get_tenant_queues
+from mail_agent.capture import CaptureWriter, read_capture, anonymize_message
 from mail_agent.utils import (
     write_file,
     execute_command,
@@ -114,6 +127,295 @@ def start() -> None:
     subprocess.run(["honcho", "start"])
 
 
+@cli.command()
+@click.option(
+    "--interval",
+    type=int,
+    help="Keep syncing the blacklist every given number of seconds.",
+    default=0,
+)
+def sync_blacklist(interval: int = 0) -> None:
+    """Sync the IP blacklist into the local snapshot used by the ip_blacklist plugin."""
+
+    load_dotenv(override=False)
+    host = os.getenv("FRAPPE_BLACKLIST_HOST")
+    path = os.getenv(
+        "BLACKLIST_SNAPSHOT_PATH", os.path.join(os.getcwd(), "blacklist.snapshot")
+    )
+
+    while True:
+        try:
+            ranges = update_snapshot(host, path)
+            click.echo(f"✅ [SUCCESS] Synced {ranges} blacklisted ranges to {path}")
+        except Exception as e:
+            click.echo(f"❌ [ERROR] Failed to sync the blacklist: {e}")
+
+        if interval <= 0:
+            break
+
+        time.sleep(interval)
+
+
+@cli.command()
+@click.option("--interval", type=float, help="Seconds between samples.", default=2)
+@click.option(
+    "--count",
+    type=int,
+    help="Number of samples to take, 0 to keep sampling.",
+    default=0,
+)
+@click.option(
+    "--json",
+    "as_json",
+    is_flag=True,
+    help="Print each sample as a line of JSON instead of a table.",
+    default=False,
+)
+def top(interval: float = 2, count: int = 0, as_json: bool = False) -> None:
+    """Show the depth, rate, ETA to empty and consumers of the Mail Agent queues."""
+
+    config = get_config(verbose=False)
+    rmq = get_rabbitmq_connection(config["rabbitmq"])
+    queues = get_monitored_queues(config["queues"])
+
+    previous = {}
+    samples = 0
+    try:
+        while True:
+            stats = []
+            sampled_at = time.time()
+            for queue in queues:
+                if not (queue_stats := rmq.get_queue_stats(queue)):
+                    continue
+
+                depth, consumers = queue_stats
+                rate = eta = None
+                if queue in previous:
+                    previous_depth, previous_sampled_at = previous[queue]
+                    # Passive declares only report the depth, so this is the net rate.
+                    rate = (depth - previous_depth) / (sampled_at - previous_sampled_at)
+                    if rate < 0:
+                        eta = depth / -rate
+
+                previous[queue] = (depth, sampled_at)
+                stats.append(
+                    {
+                        "queue": queue,
+                        "depth": depth,
+                        "rate": rate,
+                        "eta": eta,
+                        "consumers": consumers,
+                    }
+                )
+
+            if as_json:
+                click.echo(json.dumps({"timestamp": sampled_at, "queues": stats}))
+            else:
+                click.clear()
+                click.echo(format_queue_stats(stats))
+
+            samples += 1
+            if count and samples >= count:
+                break
+
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        rmq._disconnect()
+
+
+@cli.command()
+@click.option(
+    "--queue",
+    help="Queue of the delivery status events.",
+    default="mail_agent::outgoing_mails_status",
+)
+@click.option(
+    "--limit", type=int, help="Maximum number of messages to read.", default=10000
+)
+@click.option(
+    "--offset",
+    help="Read a stream queue from this offset (first, last, next, a number or an interval like 1h).",
+    default=None,
+)
+@click.option(
+    "--json",
+    "as_json",
+    is_flag=True,
+    help="Print the histograms as JSON instead of a table.",
+    default=False,
+)
+def latency(
+    queue: str = "mail_agent::outgoing_mails_status",
+    limit: int = 10000,
+    offset: str | None = None,
+    as_json: bool = False,
+) -> None:
+    """Show per-stage latency histograms from the traces of the delivery status events."""
+
+    config = get_config(verbose=False)
+    rmq = get_rabbitmq_connection(config["rabbitmq"])
+
+    aggregator = LatencyAggregator()
+    try:
+        for method, properties, body in iter_messages(rmq, queue, limit, offset):
+            for event in RabbitMQ.unpack_batch(properties, body):
+                aggregator.add(event)
+    finally:
+        rmq._disconnect()
+
+    histograms = aggregator.get_histograms()
+    if as_json:
+        click.echo(json.dumps(histograms))
+    else:
+        click.echo(format_latency_histograms(histograms))
+
+
+@cli.command()
+@click.argument("capture_file")
+@click.option(
+    "--queue",
+    help="Queue to capture, its messages are held unacked while capturing unless --offset is given.",
+    required=True,
+)
+@click.option(
+    "--limit", type=int, help="Maximum number of messages to capture.", default=10000
+)
+@click.option(
+    "--offset",
+    help="Read a stream queue from this offset (first, last, next, a number or an interval like 1h).",
+    default=None,
+)
+@click.option(
+    "--anonymize",
+    is_flag=True,
+    help="Replace the email addresses and blank the subjects of the captured messages.",
+    default=False,
+)
+def record(
+    capture_file: str,
+    queue: str,
+    limit: int = 10000,
+    offset: str | None = None,
+    anonymize: bool = False,
+) -> None:
+    """Capture the messages of a queue into a compressed, append-only capture file."""
+
+    config = get_config(verbose=False)
+    rmq = get_rabbitmq_connection(config["rabbitmq"])
+
+    count = 0
+    try:
+        messages = iter_messages(rmq, queue, limit, offset)
+        with CaptureWriter(capture_file) as writer:
+            for count, (method, properties, body) in enumerate(messages, start=1):
+                headers = properties.headers or {}
+                if anonymize:
+                    headers, body = anonymize_message(properties, body)
+
+                writer.write(
+                    {
+                        "timestamp": properties.timestamp or time.time(),
+                        "priority": properties.priority or 0,
+                        "content_type": properties.content_type,
+                        "headers": headers,
+                    },
+                    body,
+                )
+    finally:
+        rmq._disconnect()
+
+    click.echo(f"✅ [SUCCESS] Captured {count} messages from {queue} to {capture_file}")
+
+
+@cli.command()
+@click.argument("capture_file")
+@click.option(
+    "--queue", help="Queue to publish the messages to.", default="mail::outgoing_mails"
+)
+@click.option(
+    "--smtp",
+    "to_smtp",
+    is_flag=True,
+    help="Send the messages with send_mail instead of publishing them.",
+    default=False,
+)
+@click.option("--smtp-host", help="SMTP host to send to, instead of HARAKA_HOST.")
+@click.option(
+    "--smtp-port", type=int, help="SMTP port to send to, instead of HARAKA_PORT."
+)
+@click.option(
+    "--speed",
+    type=float,
+    help="Speed relative to the captured traffic, 0 to replay as fast as possible.",
+    default=1,
+)
+def replay(
+    capture_file: str,
+    queue: str = "mail::outgoing_mails",
+    to_smtp: bool = False,
+    smtp_host: str | None = None,
+    smtp_port: int | None = None,
+    speed: float = 1,
+) -> None:
+    """Replay a capture file into a queue, or straight to an SMTP server."""
+
+    config = get_config(verbose=False)
+    if to_smtp:
+        smtp = import_smtp(smtp_host, smtp_port)
+    else:
+        rmq = get_rabbitmq_connection(config["rabbitmq"])
+
+    count = failed = 0
+    started_at = time.monotonic()
+    first_timestamp = None
+    try:
+        for count, (meta, body) in enumerate(read_capture(capture_file), start=1):
+            if first_timestamp is None:
+                first_timestamp = meta["timestamp"]
+
+            if speed > 0:
+                # Keeps the captured gaps between the messages, scaled by the speed.
+                delay = (meta["timestamp"] - first_timestamp) / speed - (
+                    time.monotonic() - started_at
+                )
+                if delay > 0:
+                    time.sleep(delay)
+
+            if to_smtp:
+                properties = pika.BasicProperties(
+                    content_type=meta["content_type"], headers=meta["headers"]
+                )
+                try:
+                    smtp.send_mail(parse_mail(properties, body))
+                except (SMTPException, OSError) as e:
+                    # A captured mail the server rejects should not end the replay.
+                    failed += 1
+                    click.echo(f"❌ [ERROR] Failed to send message {count}: {e!r}")
+            else:
+                rmq.publish(
+                    routing_key=queue,
+                    body=body,
+                    priority=meta["priority"],
+                    headers=meta["headers"] or None,
+                    content_type=meta["content_type"],
+                    timestamp=int(time.time()),
+                )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if to_smtp:
+            smtp.SMTPConnectionPool().close_connections()
+        else:
+            rmq._disconnect()
+
+    elapsed = time.monotonic() - started_at
+    click.echo(
+        f"✅ [SUCCESS] Replayed {count} messages in {elapsed:.1f}s, {failed} failed"
+    )
+
+
 def setup_for_production(config: dict) -> None:
     """Setup the Mail Agent for production."""
 
@@ -124,8 +426,8 @@ def setup_for_production(config: dict) -> None:
     generate_procfile(config, for_production=True)
     create_haraka_service()
 
-    if config["haraka"]["agent_type"] == "outbound":
-        create_mail_agent_service()
+    # Outbound runs the consumers, inbound runs the blacklist sync.
+    create_mail_agent_service()
 
     click.echo("✅ [SUCCESS] Production setup complete!")
 
@@ -190,20 +492,103 @@ def generate_env_file(env_vars: dict) -> None:
     click.echo(f"✅ [INFO] .env file created at: {env_file_path}")
 
 
-def get_config() -> dict:
+def get_config(verbose: bool = True) -> dict:
     """Return the configuration from the config.json file."""
 
-    click.echo("📄 [INFO] Reading configuration from config.json...")
+    if verbose:
+        click.echo("📄 [INFO] Reading configuration from config.json...")
     with open("config.json", "r") as config_file:
         config = json.load(config_file)
 
-    click.echo("🔄 [INFO] Loading environment variables...")
+    if verbose:
+        click.echo("🔄 [INFO] Loading environment variables...")
     load_dotenv(override=False)
     replace_env_vars(config)
 
     return config
 
 
+def get_monitored_queues(queues_config: dict[str, dict]) -> list[str]:
+    """Returns the queues of the config.json file, including derived ones, and the agent's queues."""
+
+    queues = []
+    for queue, queue_config in queues_config.items():
+        queues.append(queue)
+        if fair_queueing := queue_config.get("fair_queueing"):
+            queues.extend(get_tenant_queues(queue, fair_queueing))
+        if size_classes := queue_config.get("size_classes"):
+            queues.extend(size_classes)
+        if shards := queue_config.get("shards"):
+            queues.extend(get_shard_queues(queue, shards))
+
+    queues.extend(["mail_agent::incoming_mails", "mail_agent::outgoing_mails_status"])
+    # The agent's queues can be defined in config.json as well.
+    return list(dict.fromkeys(queues))
+
+
+def iter_messages(
+    rmq: RabbitMQ, queue: str, limit: int, offset: str | None = None
+) -> Iterator[tuple]:
+    """Returns an iterator of up to `limit` messages of the queue, from the offset if it is a stream."""
+
+    if offset is not None:
+        messages = rmq.read_stream(queue, int(offset) if offset.isdigit() else offset)
+    else:
+        # The messages are not acked, so they are requeued when disconnecting.
+        messages = iter(lambda: rmq.basic_get(queue), None)
+
+    return islice(messages, limit)
+
+
+def get_rabbitmq_connection(rabbitmq_config: dict) -> RabbitMQ:
+    """Returns a RabbitMQ connection from the `rabbitmq` section of config.json."""
+
+    return RabbitMQ(
+        host=rabbitmq_config["host"],
+        port=rabbitmq_config["port"],
+        virtual_host=rabbitmq_config["virtual_host"],
+        username=rabbitmq_config["username"],
+        password=rabbitmq_config["password"],
+    )
+
+
+def format_queue_stats(stats: list[dict]) -> str:
+    """Returns the queue stats as a table."""
+
+    lines = [f"{'QUEUE':<48} {'DEPTH':>10} {'RATE/s':>10} {'ETA':>10} {'CONSUMERS':>10}"]
+    for queue_stats in stats:
+        rate = queue_stats["rate"]
+        eta = queue_stats["eta"]
+        lines.append(
+            f"{queue_stats['queue']:<48} {queue_stats['depth']:>10} "
+            f"{'-' if rate is None else f'{rate:+.1f}':>10} "
+            f"{'-' if eta is None else str(datetime.timedelta(seconds=int(eta))):>10} "
+            f"{queue_stats['consumers']:>10}"
+        )
+
+    return "\n".join(lines)
+
+
+def format_latency_histograms(histograms: dict[str, dict]) -> str:
+    """Returns the latency histograms as a table."""
+
+    def format_seconds(seconds: float | None) -> str:
+        return "-" if seconds is None else f"{seconds:.3f}s"
+
+    lines = []
+    for stage, histogram in histograms.items():
+        lines.append(
+            f"{stage} (count={histogram['count']}, p50={format_seconds(histogram['p50'])}, "
+            f"p90={format_seconds(histogram['p90'])}, p99={format_seconds(histogram['p99'])}, "
+            f"max={format_seconds(histogram['max'])})"
+        )
+        width = max(histogram["buckets"].values()) or 1
+        for bucket, count in histogram["buckets"].items():
+            lines.append(f"  {bucket:>8}s {count:>8} {'█' * round(count / width * 40)}")
+
+    return "\n".join(lines)
+
+
 def install_node_packages(for_production: bool = False) -> None:
     """Install the required Node.js packages."""
 
@@ -260,19 +645,24 @@ def generate_procfile(config: dict, for_production: bool = False) -> None:
         lines = [f"haraka: {depends_on_service} npx haraka -c ."]
 
     haraka_config = config["haraka"]
+    queues_config = config["queues"]
     consumers_config = config["consumers"]
     if haraka_config["agent_type"] == "outbound":
         depends_on_service = (
             f'./wait.sh "Haraka" {haraka_config["port"]} {haraka_config["host"]}'
         )
         for queue, consumer_config in consumers_config.items():
-            workers = consumer_config["workers"]
+            # Workers are assigned to shards round robin, every shard needs at least one.
+            shards = queues_config.get(queue, {}).get("shards", 1)
+            workers = max(consumer_config["workers"], shards)
             for worker in range(1, workers + 1):
                 worker_name = (
                     f"consumer-{queue.replace('::', '-').replace('_', '-')}-{worker}"
                 )
                 line = f"{worker_name}: {depends_on_service} python mail_agent/app.py {queue} {worker}"
                 lines.append(line)
+    elif for_production:
+        lines.append("blacklist-sync: mail-agent sync-blacklist --interval 300")
 
     with open("Procfile", "w") as f:
         f.write("\n".join(lines))
@@ -305,3 +695,22 @@ def execute_in_shell(command) -> None:
         shell=True,
         text=True,
     )
+
+
+def import_smtp(host: str | None = None, port: int | None = None):
+    """Imports the smtp module of the consumers, which run as scripts from the mail_agent directory.
+
+    Must be called before the first send, as the rate limiter is created with the first one.
+    """
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import smtp
+
+    # The replay speed sets the rate, so the worker's rate limit does not apply.
+    smtp.max_emails_per_second = 0
+    if host:
+        smtp.host = host
+    if port:
+        smtp.port = port
+
+    return smtp
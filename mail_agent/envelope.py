@@ -0,0 +1,29 @@
+import json
+
+
+# Outgoing mails published as raw MIME bytes, with the envelope in the AMQP headers.
+CONTENT_TYPE = "message/rfc822"
+
+
+def get_envelope_headers(outgoing_mail: str, recipients: list[str] | None = None) -> dict:
+    """Returns the AMQP headers of an outgoing mail published as raw MIME bytes."""
+
+    headers = {"x-outgoing-mail": outgoing_mail}
+    if recipients:
+        headers["x-recipients"] = recipients
+
+    return headers
+
+
+def parse_mail(properties, body: bytes) -> dict:
+    """Returns the outgoing mail of a raw MIME or a JSON payload, leaving raw MIME undecoded."""
+
+    if properties.content_type == CONTENT_TYPE:
+        headers = properties.headers or {}
+        return {
+            "outgoing_mail": headers["x-outgoing-mail"],
+            "recipients": list(headers.get("x-recipients") or []),
+            "message": body,
+        }
+
+    return json.loads(body)
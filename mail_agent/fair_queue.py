@@ -0,0 +1,50 @@
+import re
+import json
+import zlib
+from email.utils import parseaddr
+from email.parser import HeaderParser, BytesHeaderParser
+
+
+def get_tenant(properties, body: bytes, raw_content_type: str) -> str:
+    """Returns the tenant of the message from the `x-tenant` header or the sender domain.
+
+    `raw_content_type` is the content type of raw MIME payloads, `envelope.CONTENT_TYPE`.
+    """
+
+    if properties.headers and (tenant := properties.headers.get("x-tenant")):
+        return tenant.lower()
+
+    if properties.content_type == raw_content_type:
+        # Only the header block is parsed, as the parser decodes all it is given.
+        header_end = re.search(rb"\r?\n\r?\n", body)
+        header_block = body[: header_end.start()] if header_end else body
+        sender = BytesHeaderParser().parsebytes(header_block)["From"]
+    else:
+        mail = json.loads(body)
+        sender = HeaderParser().parsestr(mail["message"], headersonly=True)["From"]
+
+    return parseaddr(sender or "")[1].rpartition("@")[2].lower()
+
+
+def get_tenant_queue(queue: str, tenant: str, config: dict) -> str:
+    """Returns the sub-queue of the tenant, weighted tenants get a dedicated one."""
+
+    if tenant in config.get("weights", {}):
+        return f"{queue}::tenant::{tenant}"
+
+    bucket = zlib.crc32(tenant.encode()) % config.get("buckets", 8)
+    return f"{queue}::bucket::{bucket}"
+
+
+def get_tenant_queues(queue: str, config: dict) -> dict[str, int]:
+    """Returns the sub-queues of the queue mapped to their weights."""
+
+    queues = {
+        f"{queue}::tenant::{tenant}": weight
+        for tenant, weight in config.get("weights", {}).items()
+    }
+    default_weight = config.get("default_weight", 1)
+    for bucket in range(config.get("buckets", 8)):
+        queues[f"{queue}::bucket::{bucket}"] = default_weight
+
+    return queues
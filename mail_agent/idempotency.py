@@ -0,0 +1,103 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+store_path = os.getenv(
+    "IDEMPOTENCY_STORE_PATH", os.path.join(os.getcwd(), "idempotency.sqlite3")
+)
+ttl = int(os.getenv("IDEMPOTENCY_TTL", 86400))
+max_size = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 10000))
+
+
+class IdempotencyCache:
+    _instance = None
+
+    def __new__(cls, *args, **kwargs) -> "IdempotencyCache":
+        """Singleton pattern to ensure only one instance of the class is created."""
+
+        if not cls._instance:
+            cls._instance = super(IdempotencyCache, cls).__new__(cls)
+
+        return cls._instance
+
+    def __init__(
+        self, path: str, ttl: int = 86400, max_size: int = 10000, purge_every: int = 1000
+    ) -> None:
+        """Initialize the in-memory LRU and the on-disk store shared by all workers on the host."""
+
+        if not hasattr(self, "_initialized"):  # Ensure __init__ is run only once
+            self._ttl = ttl
+            self._max_size = max_size
+            self._purge_every = purge_every
+            self._writes = 0
+
+            self._lock = threading.Lock()
+            self._cache: OrderedDict[str, float] = OrderedDict()
+            self._connection = sqlite3.connect(
+                path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS sent_mails "
+                "(outgoing_mail TEXT PRIMARY KEY, expires_at REAL NOT NULL) WITHOUT ROWID"
+            )
+            self._initialized = True
+
+    def __remember(self, key: str, expires_at: float) -> None:
+        """Store the key in the in-memory LRU, evicting the least recently used key."""
+
+        self._cache[key] = expires_at
+        self._cache.move_to_end(key)
+
+        if len(self._cache) > self._max_size:
+            self._cache.popitem(last=False)
+
+    def contains(self, key: str) -> bool:
+        """Returns True if the key was added and has not expired yet."""
+
+        now = time.time()
+        with self._lock:
+            if (expires_at := self._cache.get(key)) is not None:
+                if expires_at > now:
+                    self._cache.move_to_end(key)
+                    return True
+
+                del self._cache[key]
+
+            row = self._connection.execute(
+                "SELECT expires_at FROM sent_mails WHERE outgoing_mail = ? AND expires_at > ?",
+                (key, now),
+            ).fetchone()
+
+            if row:
+                self.__remember(key, row[0])
+                return True
+
+        return False
+
+    def add(self, key: str) -> None:
+        """Marks the key as processed until the TTL expires."""
+
+        expires_at = time.time() + self._ttl
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO sent_mails (outgoing_mail, expires_at) VALUES (?, ?)",
+                (key, expires_at),
+            )
+            self.__remember(key, expires_at)
+
+            self._writes += 1
+            if self._writes % self._purge_every == 0:
+                self._connection.execute(
+                    "DELETE FROM sent_mails WHERE expires_at <= ?", (time.time(),)
+                )
+
+
+def get_idempotency_cache() -> IdempotencyCache:
+    """Returns the singleton instance of the idempotency cache."""
+
+    return IdempotencyCache(store_path, ttl=ttl, max_size=max_size)
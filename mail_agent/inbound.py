@@ -0,0 +1,12 @@
+def expand_recipients(properties, body: bytes) -> list[bytes]:
+    """Returns a copy of the incoming mail per recipient with the `Delivered-To` header prepended."""
+
+    headers = properties.headers or {}
+    if "x-recipients" not in headers:
+        # Published per recipient, the `Delivered-To` header is already prepended.
+        return [body]
+
+    return [
+        f"Delivered-To: {recipient}\r\n".encode() + body
+        for recipient in headers["x-recipients"]
+    ]
@@ -0,0 +1,63 @@
+import bisect
+
+
+# Stage: (status hook that reports it, start timestamp, end timestamp)
+STAGES = {
+    "queue_wait": ("queue_ok", "enqueued_at", "received_at"),
+    "worker": ("queue_ok", "received_at", "submitted_at"),
+    "smtp_accept": ("queue_ok", "submitted_at", "queued_at"),
+    "remote_delivery": ("delivered", "queued_at", "delivered_at"),
+    "total": ("delivered", "enqueued_at", "delivered_at"),
+}
+BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600]
+
+
+class LatencyAggregator:
+    def __init__(self) -> None:
+        """Initializes the aggregator of the per-stage latencies."""
+
+        self.samples: dict[str, list[float]] = {stage: [] for stage in STAGES}
+
+    def add(self, event: dict) -> None:
+        """Adds the stage latencies of a delivery status event with a trace."""
+
+        trace = event.get("trace") or {}
+        for stage, (hook, start, end) in STAGES.items():
+            if event.get("hook") != hook:
+                continue
+
+            if trace.get(start) is not None and trace.get(end) is not None:
+                self.samples[stage].append(max(trace[end] - trace[start], 0))
+
+    def get_histograms(self) -> dict[str, dict]:
+        """Returns the count, percentiles and histogram of each stage's latency in seconds."""
+
+        histograms = {}
+        for stage, samples in self.samples.items():
+            samples = sorted(samples)
+            buckets = dict.fromkeys([f"<={bucket}" for bucket in BUCKETS], 0)
+            buckets[f">{BUCKETS[-1]}"] = 0
+            for sample in samples:
+                index = bisect.bisect_left(BUCKETS, sample)
+                buckets[list(buckets)[index]] += 1
+
+            histograms[stage] = {
+                "count": len(samples),
+                "p50": get_percentile(samples, 50),
+                "p90": get_percentile(samples, 90),
+                "p99": get_percentile(samples, 99),
+                "max": samples[-1] if samples else None,
+                "buckets": buckets,
+            }
+
+        return histograms
+
+
+def get_percentile(samples: list[float], percentile: float) -> float | None:
+    """Returns the percentile of the sorted samples using the nearest rank."""
+
+    if not samples:
+        return None
+
+    rank = max(int(len(samples) * percentile / 100 + 0.5), 1)
+    return samples[min(rank, len(samples)) - 1]
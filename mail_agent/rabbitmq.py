@@ -1,5 +1,49 @@
+import json
 import pika
-from typing import Any, NoReturn
+import signal
+import threading
+from typing import Any, Iterator
+from functools import partial
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+LEGACY_MASTER_LOCATORS = ("min-masters", "random")
+
+
+class ThreadSafeChannel:
+    def __init__(self, connection: pika.BlockingConnection, channel: Any) -> None:
+        """Initializes the proxy that hands channel operations over to the connection's thread."""
+
+        self._connection = connection
+        self._channel = channel
+
+    def basic_ack(self, delivery_tag: int = 0, multiple: bool = False) -> None:
+        """Acknowledges the message from the connection's thread."""
+
+        self._connection.add_callback_threadsafe(
+            partial(self._channel.basic_ack, delivery_tag, multiple)
+        )
+
+    def basic_nack(
+        self, delivery_tag: int = 0, multiple: bool = False, requeue: bool = True
+    ) -> None:
+        """Negatively acknowledges the message from the connection's thread."""
+
+        self._connection.add_callback_threadsafe(
+            partial(self._channel.basic_nack, delivery_tag, multiple, requeue)
+        )
+
+    def basic_publish(self, **kwargs) -> None:
+        """Publishes the message from the connection's thread."""
+
+        self._connection.add_callback_threadsafe(
+            partial(self._channel.basic_publish, **kwargs)
+        )
+
+    def call(self, func: callable, *args) -> None:
+        """Calls `func(channel, *args)` from the connection's thread."""
+
+        self._connection.add_callback_threadsafe(partial(func, self._channel, *args))
 
 
 class RabbitMQ(pika.BlockingConnection):
@@ -34,32 +78,89 @@ class RabbitMQ(pika.BlockingConnection):
 
         super().__init__(parameters)
         self._channel = self.channel()
+        self._confirming = False
+        self._stopping = False
+        self._timed_out = False
+        self._shutdown_timeout = 30
+        self._executor: ThreadPoolExecutor | None = None
+        self._error: BaseException | None = None
 
     def declare_queue(
-        self, queue: str, max_priority: int = 0, durable: bool = True
+        self,
+        queue: str,
+        max_priority: int = 0,
+        durable: bool = True,
+        queue_type: str = "classic",
+        max_age: str | None = None,
+        max_length_bytes: int | None = None,
+        stream_max_segment_size_bytes: int | None = None,
+        leader_locator: str | None = None,
     ) -> None:
         """Declares a queue with the given name and arguments."""
 
+        if max_priority > 0 and queue_type != "classic":
+            # The broker would close the channel with an opaque PRECONDITION_FAILED.
+            raise ValueError(
+                f"Queue {queue}: max_priority is only supported by classic queues, not {queue_type} queues."
+            )
+
+        arguments = {}
         if max_priority > 0:
+            arguments["x-max-priority"] = max_priority
+        if queue_type != "classic":
+            arguments["x-queue-type"] = queue_type
+        if max_age:
+            arguments["x-max-age"] = max_age
+        if max_length_bytes:
+            arguments["x-max-length-bytes"] = max_length_bytes
+        if stream_max_segment_size_bytes:
+            arguments["x-stream-max-segment-size-bytes"] = stream_max_segment_size_bytes
+        if leader_locator in LEGACY_MASTER_LOCATORS:
+            # Brokers older than 3.10 only know the classic queue master locator.
+            arguments["x-queue-master-locator"] = leader_locator
+        elif leader_locator:
+            arguments["x-queue-leader-locator"] = leader_locator
+
+        if arguments:
             self._channel.queue_declare(
-                queue=queue, arguments={"x-max-priority": max_priority}, durable=durable
+                queue=queue, arguments=arguments, durable=durable
             )
         else:
             self._channel.queue_declare(queue=queue, durable=durable)
 
+    def declare_exchange(
+        self, exchange: str, exchange_type: str = "direct", durable: bool = True
+    ) -> None:
+        """Declares an exchange with the given name and type."""
+
+        self._channel.exchange_declare(
+            exchange=exchange, exchange_type=exchange_type, durable=durable
+        )
+
+    def bind_queue(self, queue: str, exchange: str, routing_key: str = "") -> None:
+        """Binds the queue to the exchange with the given routing key."""
+
+        self._channel.queue_bind(queue=queue, exchange=exchange, routing_key=routing_key)
+
     def publish(
         self,
         routing_key: str,
-        body: str,
+        body: str | bytes,
         exchange: str = "",
         priority: int = 0,
         persistent: bool = True,
+        headers: dict | None = None,
+        content_type: str | None = None,
+        timestamp: int | None = None,
     ) -> None:
         """Publishes a message to the exchange with the given routing key."""
 
         properties = pika.BasicProperties(
             delivery_mode=pika.DeliveryMode.Persistent if persistent else None,
             priority=priority if priority > 0 else None,
+            headers=headers,
+            content_type=content_type,
+            timestamp=timestamp,
         )
         self._channel.basic_publish(
             exchange=exchange,
@@ -68,22 +169,310 @@ class RabbitMQ(pika.BlockingConnection):
             properties=properties,
         )
 
+    def publish_batch(
+        self,
+        routing_key: str,
+        messages: list,
+        exchange: str = "",
+        priority: int = 0,
+        persistent: bool = True,
+    ) -> None:
+        """Publishes the messages as a single JSON array message."""
+
+        self.publish(
+            routing_key=routing_key,
+            body=json.dumps(messages),
+            exchange=exchange,
+            priority=priority,
+            persistent=persistent,
+            headers={"x-batch-size": len(messages)},
+        )
+
+    @staticmethod
+    def unpack_batch(properties, body: bytes) -> list:
+        """Returns the messages of a batch, or a single JSON message as a list of one."""
+
+        if properties.headers and "x-batch-size" in properties.headers:
+            return json.loads(body)
+
+        return [json.loads(body)]
+
     def consume(
         self,
-        queue: str,
+        queue: str | list[str],
         callback: callable,
         auto_ack: bool = False,
         prefetch_count: int = 0,
-    ) -> NoReturn:
-        """Consumes messages from the queue with the given callback."""
+        shutdown_timeout: float = 30,
+        concurrency: int = 1,
+        stream_offset: str | int | None = None,
+    ) -> None:
+        """Consumes messages from the queue(s) with the given callback until SIGTERM or SIGINT is received."""
+
+        if prefetch_count > 0:
+            self._channel.basic_qos(prefetch_count=prefetch_count)
+
+        if concurrency > 1:
+            callback = self._dispatch_concurrently(callback, concurrency)
+        if not auto_ack:
+            callback = self._requeue_when_stopping(callback)
+
+        # Stream queues are consumed from the given offset instead of destructively.
+        arguments = {"x-stream-offset": stream_offset} if stream_offset is not None else None
+        for queue in [queue] if isinstance(queue, str) else queue:
+            self._channel.basic_consume(
+                queue=queue,
+                on_message_callback=callback,
+                auto_ack=auto_ack,
+                arguments=arguments,
+            )
+
+        self._handle_shutdown_signals(shutdown_timeout)
+        try:
+            while not self._stopping:
+                self.process_data_events(time_limit=1)
+                self._raise_worker_error()
+        finally:
+            self._drain()
+
+    def consume_fair(
+        self,
+        queues: dict[str, int],
+        callback: callable,
+        auto_ack: bool = False,
+        prefetch_count: int = 0,
+        shutdown_timeout: float = 30,
+        concurrency: int = 1,
+    ) -> None:
+        """Consumes messages from the weighted queues using deficit round robin until SIGTERM or SIGINT is received."""
 
         if prefetch_count > 0:
             self._channel.basic_qos(prefetch_count=prefetch_count)
 
+        if concurrency > 1:
+            callback = self._dispatch_concurrently(callback, concurrency)
+
+        buffers = {queue: deque() for queue in queues}
+        deficits = dict.fromkeys(queues, 0)
+        for queue, buffer in buffers.items():
+            self._channel.basic_consume(
+                queue=queue,
+                on_message_callback=lambda channel, *message, buffer=buffer: buffer.append(
+                    message
+                ),
+                auto_ack=auto_ack,
+            )
+
+        self._handle_shutdown_signals(shutdown_timeout)
+        try:
+            while not self._stopping:
+                self.process_data_events(time_limit=0 if any(buffers.values()) else 1)
+                self._raise_worker_error()
+
+                for queue, weight in queues.items():
+                    buffer = buffers[queue]
+                    if not buffer:
+                        deficits[queue] = 0
+                        continue
+
+                    deficits[queue] += weight
+                    while buffer and deficits[queue] >= 1 and not self._stopping:
+                        callback(self._channel, *buffer.popleft())
+                        deficits[queue] -= 1
+
+            if not auto_ack:
+                for buffer in buffers.values():
+                    for method, properties, body in buffer:
+                        self._channel.basic_nack(
+                            delivery_tag=method.delivery_tag, requeue=True
+                        )
+        finally:
+            self._drain()
+
+    def read_stream(
+        self,
+        queue: str,
+        offset: str | int = "first",
+        prefetch_count: int = 1000,
+        inactivity_timeout: float = 1,
+    ) -> Iterator[tuple[Any, Any, bytes]]:
+        """Yields the messages of the stream queue from the offset until none arrive within the timeout."""
+
+        self._channel.basic_qos(prefetch_count=prefetch_count)
+
+        unacked = 0
+        try:
+            for method, properties, body in self._channel.consume(
+                queue,
+                arguments={"x-stream-offset": offset},
+                inactivity_timeout=inactivity_timeout,
+            ):
+                if method is None:
+                    break
+
+                yield method, properties, body
+
+                # Stream acks only grant credit for more messages, so they are batched.
+                unacked += 1
+                if unacked >= max(prefetch_count // 2, 1):
+                    self._channel.basic_ack(
+                        delivery_tag=method.delivery_tag, multiple=True
+                    )
+                    unacked = 0
+        finally:
+            self._channel.cancel()
+
+    def confirm_delivery(self) -> None:
+        """Puts the channel in confirm mode, so that publishing blocks until the broker confirms."""
+
+        if not self._confirming:
+            self._channel.confirm_delivery()
+            self._confirming = True
+
+    def route(
+        self, queue: str, get_routing_key: callable, prefetch_count: int = 0
+    ) -> None:
+        """Republishes the messages of the queue to the queue returned by `get_routing_key(properties, body)`."""
+
+        def republish(channel, method, properties, body) -> None:
+            self.forward(
+                channel, method, properties, body, get_routing_key(properties, body)
+            )
+
+        if prefetch_count > 0:
+            self._channel.basic_qos(prefetch_count=prefetch_count)
+
+        # The original is acked as soon as the copy is published, so it must be confirmed first.
+        self.confirm_delivery()
         self._channel.basic_consume(
-            queue=queue, on_message_callback=callback, auto_ack=auto_ack
+            queue=queue, on_message_callback=self._requeue_when_stopping(republish)
+        )
+
+    @staticmethod
+    def forward(channel, method, properties, body: bytes, routing_key: str) -> None:
+        """Publishes the message to the routing key and acks the original delivery.
+
+        The channel should be in confirm mode, so that the original is only acked once the broker
+        has confirmed the copy, and a failed publish raises instead.
+        """
+
+        if isinstance(channel, ThreadSafeChannel):
+            # Publishes and acks in a single callback, so that a failed publish is never acked.
+            channel.call(RabbitMQ.forward, method, properties, body, routing_key)
+            return
+
+        # If the ack is lost, the original is forwarded again and both copies arrive as first
+        # deliveries, so consumers must treat copies like redeliveries.
+        properties.headers = {**(properties.headers or {}), "x-forwarded": True}
+        channel.basic_publish(
+            exchange="", routing_key=routing_key, body=body, properties=properties
         )
-        self._channel.start_consuming()
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    def _dispatch_concurrently(self, callback: callable, concurrency: int) -> callable:
+        """Returns a callback that runs the given callback on up to `concurrency` threads."""
+
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        slots = threading.Semaphore(concurrency)
+        channel = ThreadSafeChannel(self, self._channel)
+
+        def on_done(future: Future) -> None:
+            slots.release()
+            if error := future.exception():
+                self._error = error
+
+        def dispatch(_channel, method, properties, body) -> None:
+            # Blocks the connection's thread while all threads are busy, so that
+            # messages are not taken from the prefetch buffer any faster than they are sent.
+            slots.acquire()
+            if self._stopping:
+                # The shutdown was requested while waiting for a free thread.
+                slots.release()
+                self._channel.basic_reject(delivery_tag=method.delivery_tag, requeue=True)
+                return
+
+            future = self._executor.submit(callback, channel, method, properties, body)
+            future.add_done_callback(on_done)
+
+        return dispatch
+
+    def _requeue_when_stopping(self, callback: callable) -> callable:
+        """Returns a callback that requeues the messages delivered after a shutdown was requested."""
+
+        def on_message(channel, method, properties, body) -> None:
+            # pika dispatches all the prefetched deliveries in one go, so the
+            # ones behind the in-flight message still arrive after the signal.
+            if self._stopping:
+                self._channel.basic_reject(delivery_tag=method.delivery_tag, requeue=True)
+                return
+
+            callback(channel, method, properties, body)
+
+        return on_message
+
+    def _raise_worker_error(self) -> None:
+        """Re-raises the error of a failed callback thread like a synchronous callback would."""
+
+        if self._error:
+            raise self._error
+
+    def _handle_shutdown_signals(self, shutdown_timeout: float) -> None:
+        """Installs SIGTERM and SIGINT handlers that request a graceful shutdown."""
+
+        self._shutdown_timeout = shutdown_timeout
+        signal.signal(signal.SIGTERM, self.__request_shutdown)
+        signal.signal(signal.SIGINT, self.__request_shutdown)
+        signal.signal(signal.SIGALRM, self.__shutdown_timed_out)
+
+    def __request_shutdown(self, signum: int, frame: Any) -> None:
+        """Stops consuming once the in-flight messages are processed, within the shutdown timeout.
+
+        The messages delivered after the signal are requeued without being processed.
+        """
+
+        if self._stopping:
+            return
+
+        print(f"Received signal {signum}, shutting down gracefully...")
+        self._stopping = True
+        # Unlike alarm(), the timer accepts fractional seconds.
+        signal.setitimer(signal.ITIMER_REAL, self._shutdown_timeout)
+
+    def __shutdown_timed_out(self, signum: int, frame: Any) -> None:
+        """Aborts the in-flight message, leaving it unacked so that it is redelivered."""
+
+        self._timed_out = True
+        raise TimeoutError(
+            f"Graceful shutdown did not finish within {self._shutdown_timeout} seconds."
+        )
+
+    def _drain(self) -> None:
+        """Cancels the consumers, flushes pending acks and disconnects."""
+
+        try:
+            # Cancelling requeues the prefetched messages that were not processed yet.
+            self._channel.stop_consuming()
+            if self._executor:
+                # Past the timeout, the threads still sending are not waited for.
+                self._executor.shutdown(wait=not self._timed_out, cancel_futures=True)
+
+            self.process_data_events(time_limit=0)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            self._disconnect()
+
+    def get_queue_stats(self, queue: str) -> tuple[int, int] | None:
+        """Returns the message and consumer counts of the queue, or None if it does not exist."""
+
+        try:
+            result = self._channel.queue_declare(queue=queue, passive=True)
+        except pika.exceptions.ChannelClosedByBroker:
+            # The broker closes the channel if a passively declared queue does not exist.
+            self._channel = self.channel()
+            self._confirming = False
+            return None
+
+        return result.method.message_count, result.method.consumer_count
 
     def basic_get(
         self,
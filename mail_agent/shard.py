@@ -0,0 +1,10 @@
+def get_shard_queues(queue: str, shards: int) -> list[str]:
+    """Returns the shard queues of the queue."""
+
+    return [f"{queue}::shard::{shard}" for shard in range(1, shards + 1)]
+
+
+def get_shard_queue(queue: str, worker_id: int, shards: int) -> str:
+    """Returns the shard queue consumed by the worker, spreading workers evenly across shards."""
+
+    return f"{queue}::shard::{(worker_id - 1) % shards + 1}"
@@ -0,0 +1,197 @@
+import os
+import re
+import time
+import base64
+import hashlib
+import threading
+import multiprocessing
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+
+SIGNED_HEADERS = [
+    "from",
+    "sender",
+    "reply-to",
+    "subject",
+    "date",
+    "message-id",
+    "to",
+    "cc",
+    "mime-version",
+    "content-type",
+    "content-transfer-encoding",
+    "in-reply-to",
+    "references",
+]
+
+
+@lru_cache(maxsize=None)
+def load_private_key(key_path: str):
+    """Returns the parsed private key, cached for the lifetime of the process."""
+
+    from cryptography.hazmat.primitives import serialization
+
+    with open(key_path, "rb") as f:
+        return serialization.load_pem_private_key(f.read(), password=None)
+
+
+def get_algorithm(key_path: str) -> str:
+    """Returns the DKIM signing algorithm of the private key."""
+
+    from cryptography.hazmat.primitives.asymmetric import ed25519
+
+    if isinstance(load_private_key(key_path), ed25519.Ed25519PrivateKey):
+        return "ed25519-sha256"
+
+    return "rsa-sha256"
+
+
+def sign_digest(key_path: str, digest: bytes) -> bytes:
+    """Signs the SHA-256 digest of the canonicalized headers, runs in the signing processes."""
+
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ed25519, padding, utils
+
+    private_key = load_private_key(key_path)
+    if isinstance(private_key, ed25519.Ed25519PrivateKey):
+        # RFC 8463 signs the SHA-256 hash of the data with PureEdDSA.
+        return private_key.sign(digest)
+
+    return private_key.sign(
+        digest, padding.PKCS1v15(), utils.Prehashed(hashes.SHA256())
+    )
+
+
+def canonicalize_body(body: bytes) -> bytes:
+    """Returns the body in the DKIM relaxed canonicalization."""
+
+    lines = [
+        re.sub(rb"[ \t]+", b" ", line).rstrip(b" ") for line in body.split(b"\r\n")
+    ]
+    while lines and not lines[-1]:
+        lines.pop()
+
+    return b"\r\n".join(lines) + b"\r\n" if lines else b""
+
+
+def canonicalize_header(name: bytes, value: bytes) -> bytes:
+    """Returns the header in the DKIM relaxed canonicalization, without the trailing CRLF."""
+
+    value = re.sub(rb"[ \t]+", b" ", value.replace(b"\r\n", b"")).strip(b" ")
+    return name.strip().lower() + b":" + value
+
+
+def parse_headers(header_block: bytes) -> list[tuple[bytes, bytes]]:
+    """Returns the headers of the header block as (name, value) pairs, keeping their folding."""
+
+    headers = []
+    for line in header_block.split(b"\r\n"):
+        if line[:1] in (b" ", b"\t") and headers:
+            name, value = headers[-1]
+            headers[-1] = (name, value + b"\r\n" + line)
+        else:
+            name, _, value = line.partition(b":")
+            headers.append((name, value))
+
+    return headers
+
+
+class DKIMSigner:
+    _instance = None
+
+    def __new__(cls, *args, **kwargs) -> "DKIMSigner":
+        """Singleton pattern to ensure only one instance of the class is created."""
+
+        if not cls._instance:
+            cls._instance = super(DKIMSigner, cls).__new__(cls)
+
+        return cls._instance
+
+    def __init__(self, keys_dir: str, processes: int | None = None) -> None:
+        """Initialize the signer with the `<keys_dir>/<domain>/<selector>.pem` private keys.
+
+        Signs with a pool of `processes` processes, one per CPU if None, or inline if 0.
+        """
+
+        if not hasattr(self, "_initialized"):  # Ensure __init__ is run only once
+            self._keys_dir = keys_dir
+            self._keys: dict[str, list[tuple[str, str, str]]] = {}
+            self._lock = threading.Lock()
+            self._executor = None
+            if processes != 0:
+                # Spawned, as forking a process with open connections and threads is unsafe.
+                self._executor = ProcessPoolExecutor(
+                    max_workers=processes or os.cpu_count(),
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            self._initialized = True
+
+    def get_keys(self, domain: str) -> list[tuple[str, str, str]]:
+        """Returns the (selector, key path, algorithm) of the domain's keys, cached per domain."""
+
+        with self._lock:
+            if domain not in self._keys:
+                domain_dir = os.path.join(self._keys_dir, domain)
+                keys = []
+                if os.path.isdir(domain_dir):
+                    for file in sorted(os.listdir(domain_dir)):
+                        if file.endswith(".pem"):
+                            key_path = os.path.join(domain_dir, file)
+                            keys.append((file[:-4], key_path, get_algorithm(key_path)))
+
+                self._keys[domain] = keys
+
+            return self._keys[domain]
+
+    def sign(self, message: str | bytes, domain: str) -> str | bytes:
+        """Returns the message with a DKIM-Signature header prepended per key of the domain."""
+
+        if not (keys := self.get_keys(domain)):
+            return message
+
+        is_str = isinstance(message, str)
+        if is_str:
+            message = message.encode("utf-8", "surrogateescape")
+
+        if message.count(b"\n") != message.count(b"\r\n"):
+            message = re.sub(rb"(?<!\r)\n", b"\r\n", message)
+        header_block, _, body = message.partition(b"\r\n\r\n")
+        headers = parse_headers(header_block)
+
+        # The last instance of each signed header, as verifiers pick them from the bottom up.
+        signed_headers = {}
+        for name, value in headers:
+            if (header_name := name.strip().lower().decode(errors="replace")) in SIGNED_HEADERS:
+                signed_headers[header_name] = canonicalize_header(name, value)
+
+        header_names = [name for name in SIGNED_HEADERS if name in signed_headers]
+        header_data = b"".join(signed_headers[name] + b"\r\n" for name in header_names)
+        body_hash = base64.b64encode(
+            hashlib.sha256(canonicalize_body(body)).digest()
+        ).decode()
+
+        signatures = []
+        for selector, key_path, algorithm in keys:
+            tags = (
+                f"v=1; a={algorithm}; c=relaxed/relaxed; d={domain}; s={selector}; "
+                f"t={int(time.time())}; h={':'.join(header_names)}; bh={body_hash}; b="
+            )
+            data = header_data + canonicalize_header(b"DKIM-Signature", tags.encode())
+            digest = hashlib.sha256(data).digest()
+            if self._executor:
+                signatures.append((tags, self._executor.submit(sign_digest, key_path, digest)))
+            else:
+                signatures.append((tags, sign_digest(key_path, digest)))
+
+        signature_headers = []
+        for tags, signature in signatures:
+            if self._executor:
+                signature = signature.result()
+            signature_headers.append(
+                f"DKIM-Signature: {tags}{base64.b64encode(signature).decode()}\r\n"
+            )
+
+        signed_message = "".join(signature_headers).encode() + message
+
+        return signed_message.decode("utf-8", "surrogateescape") if is_str else signed_message
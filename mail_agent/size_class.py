@@ -0,0 +1,24 @@
+from rabbitmq import RabbitMQ
+
+
+def get_size_class_queue(size: int, size_classes: dict[str, int]) -> str | None:
+    """Returns the queue of the largest size class whose minimum size the payload reaches."""
+
+    size_class_queue, min_size = None, 0
+    for queue, class_min_size in size_classes.items():
+        if min_size <= class_min_size <= size:
+            size_class_queue, min_size = queue, class_min_size
+
+    return size_class_queue
+
+
+def route_by_size(callback: callable, size_classes: dict[str, int]) -> callable:
+    """Returns a callback that forwards payloads of a size class to its queue and handles the rest."""
+
+    def wrapper(channel, method, properties, body) -> None:
+        if size_class_queue := get_size_class_queue(len(body), size_classes):
+            RabbitMQ.forward(channel, method, properties, body, size_class_queue)
+        else:
+            callback(channel, method, properties, body)
+
+    return wrapper
@@ -1,10 +1,14 @@
 import os
+import re
 import time
 import threading
 from queue import Queue
 from email import policy
-from smtplib import SMTP
-from email.parser import Parser
+from smtplib import SMTP, SMTPException, SMTPRecipientsRefused, SMTPResponseException
+from email.parser import Parser, BytesHeaderParser
+from email.utils import parseaddr
+from concurrent.futures import ThreadPoolExecutor
+from signing import DKIMSigner
 
 
 host = os.getenv("HARAKA_HOST", "localhost")
@@ -12,6 +16,14 @@ port = int(os.getenv("HARAKA_PORT", 25))
 username = os.getenv("HARAKA_USERNAME", None)
 password = os.getenv("HARAKA_PASSWORD", None)
 max_emails_per_second = float(os.getenv("MAX_EMAILS_PER_SECOND_PER_WORKER", 0.5))
+dkim_keys_dir = os.getenv("DKIM_KEYS_DIR", None)
+dkim_signing_processes = int(os.getenv("DKIM_SIGNING_PROCESSES", 0)) or None
+# Off by default, as each chunk is a Haraka transaction with its own queue_id and statuses.
+max_recipients_per_transaction = int(os.getenv("MAX_RECIPIENTS_PER_TRANSACTION", 0))
+max_parallel_transactions = int(os.getenv("MAX_PARALLEL_TRANSACTIONS", 4))
+
+# Shared by the consumer threads, the chunks of a message are sent over separate connections.
+transaction_executor = ThreadPoolExecutor(max_workers=max(max_parallel_transactions, 1))
 
 
 class SMTPConnectionPool:
@@ -89,7 +101,10 @@ class SMTPConnectionPool:
         with self._condition:
             while not self._pool.empty():
                 connection: SMTP = self._pool.get()
-                connection.quit()
+                try:
+                    connection.quit()
+                except (SMTPException, OSError):
+                    connection.close()
 
             self._condition.notify_all()
 
@@ -111,6 +126,7 @@ class EmailRateLimiter:
         if not hasattr(self, "_initialized"):  # Ensure __init__ is run only once
             self.max_emails_per_second = max_emails_per_second
             self.emails_sent = 0
+            self._lock = threading.Lock()
             self.start_time = time.time()
             self._initialized = True
 
@@ -120,19 +136,23 @@ class EmailRateLimiter:
         if self.max_emails_per_second <= 0:
             return
 
-        self.emails_sent += 1
-        elapsed_time = time.time() - self.start_time
-        expected_emails = elapsed_time * self.max_emails_per_second
-
-        if self.emails_sent > expected_emails:
-            sleep_time = (self.emails_sent / self.max_emails_per_second) - elapsed_time
-            if sleep_time > 0:
-                time.sleep(sleep_time)
-            self.start_time = time.time()
-            self.emails_sent = 0
-        else:
-            self.start_time = time.time()
-            self.emails_sent = 0
+        # Held while sleeping, so that concurrent senders share the worker's rate.
+        with self._lock:
+            self.emails_sent += 1
+            elapsed_time = time.time() - self.start_time
+            expected_emails = elapsed_time * self.max_emails_per_second
+
+            if self.emails_sent > expected_emails:
+                sleep_time = (
+                    self.emails_sent / self.max_emails_per_second
+                ) - elapsed_time
+                if sleep_time > 0:
+                    time.sleep(sleep_time)
+                self.start_time = time.time()
+                self.emails_sent = 0
+            else:
+                self.start_time = time.time()
+                self.emails_sent = 0
 
 
 def get_rate_limiter() -> EmailRateLimiter:
@@ -141,13 +161,122 @@ def get_rate_limiter() -> EmailRateLimiter:
     return EmailRateLimiter(max_emails_per_second=max_emails_per_second)
 
 
-def send_mail(mail: dict) -> None:
-    """Send an email message using the SMTP connection pool, with rate limiting."""
+def normalize_line_endings(message: bytes) -> bytes:
+    """Returns the message with CRLF line endings, copying it only if it has bare LFs."""
+
+    if message.count(b"\n") == message.count(b"\r\n"):
+        return message
+
+    return re.sub(rb"(?<!\r)\n", b"\r\n", message)
+
+
+def remove_header(message: bytes, name: bytes) -> bytes:
+    """Removes every instance of the header from the raw message, leaving the rest untouched.
+
+    The message is returned as it is, without copying the body, if it has no such header.
+    """
+
+    header_end = message.find(b"\r\n\r\n")
+    if header_end == -1:
+        header_end = len(message)
+
+    lines = []
+    removing = removed = False
+    for line in message[:header_end].split(b"\r\n"):
+        if line[:1] not in (b" ", b"\t"):
+            removing = line.partition(b":")[0].strip().lower() == name.lower()
+        if removing:
+            removed = True
+        else:
+            lines.append(line)
+
+    if not removed:
+        return message
+
+    return b"\r\n".join(lines) + message[header_end:]
+
+
+def format_trace(trace: dict) -> str:
+    """Returns the stage timestamps as the value of the X-FM-Trace header."""
+
+    return "; ".join(
+        f"{stage}={timestamp:.3f}"
+        for stage, timestamp in trace.items()
+        if timestamp is not None
+    )
+
+
+def configure_dkim_signing(concurrency: int, workers: int) -> None:
+    """Sizes the DKIM signing pool of the worker, signing inline when it sends one mail at a time."""
+
+    global dkim_signing_processes
+    if concurrency <= 1:
+        # Sending waits for the signature, so a pool would only add a round trip.
+        dkim_signing_processes = 0
+    elif not dkim_signing_processes:
+        # The CPUs are shared by all the workers of the host.
+        dkim_signing_processes = max((os.cpu_count() or 1) // workers, 1)
+
+
+def get_dkim_signer() -> DKIMSigner:
+    """Returns the singleton instance of the DKIM signer."""
+
+    return DKIMSigner(dkim_keys_dir, processes=dkim_signing_processes)
+
+
+def send_transaction(
+    smtp_pool: SMTPConnectionPool,
+    sender: str,
+    recipients: list[str],
+    message: str | bytes,
+) -> dict[str, tuple[int, bytes]]:
+    """Sends the message to the recipients in one transaction, returning the refused recipients."""
+
+    connection = smtp_pool.get_connection()
+    try:
+        refused = connection.sendmail(sender, recipients, message)
+    except SMTPRecipientsRefused as e:
+        # Every recipient was refused, the transaction was reset and the connection is reusable.
+        refused = e.recipients
+    except BaseException:
+        # The state of the connection is unknown after a failed transaction.
+        connection.close()
+        raise
+
+    smtp_pool.return_connection(connection)
+    return refused
+
+
+def get_error_response(error: Exception) -> tuple[int, bytes]:
+    """Returns the SMTP reply of a failed transaction, 421 if the connection failed."""
+
+    if isinstance(error, SMTPResponseException):
+        return error.smtp_code, error.smtp_error
+
+    return 421, str(error).encode()
+
+
+def send_mail(mail: dict, trace: dict | None = None) -> dict[str, tuple[int, bytes]]:
+    """Send an email message using the SMTP connection pool, with rate limiting.
+
+    Recipients are sent in chunks of up to `MAX_RECIPIENTS_PER_TRANSACTION` per transaction, in
+    parallel. The recipients refused by the server, and those of failed transactions once another
+    transaction was accepted, are returned with the SMTP reply instead of failing the message.
+    """
 
     global host, port, username, password
     outgoing_mail = mail["outgoing_mail"]
     recipients = mail.get("recipients", [])
-    parsed_message = Parser(policy=policy.default).parsestr(mail["message"])
+
+    message = None
+    if isinstance(mail["message"], bytes):
+        # Raw MIME bytes are sent as they are, only the header block is parsed.
+        message = normalize_line_endings(mail["message"])
+        parsed_message = BytesHeaderParser(policy=policy.default).parsebytes(
+            message.partition(b"\r\n\r\n")[0]
+        )
+    else:
+        parsed_message = Parser(policy=policy.default).parsestr(mail["message"])
 
     if not recipients:
         for type in ["To", "Cc", "Bcc"]:
@@ -155,18 +284,75 @@ def send_mail(mail: dict) -> None:
                 for rcpt in rcpts.split(","):
                     recipients.append(rcpt.strip())
 
-    del parsed_message["Bcc"]
+    if not recipients:
+        raise SMTPRecipientsRefused({})
 
     sender = parsed_message["From"]
-    message = parsed_message.as_string()
+    if message is None:
+        del parsed_message["Bcc"]
+        message = parsed_message.as_string()
+    else:
+        message = remove_header(message, b"Bcc")
+
+    if dkim_keys_dir:
+        domain = parseaddr(sender)[1].rpartition("@")[2].lower()
+        message = get_dkim_signer().sign(message, domain)
+
+    if trace is not None:
+        # Haraka removes the header and reports the stages with the delivery status.
+        trace["submitted_at"] = time.time()
+        trace_header = f"X-FM-Trace: {format_trace(trace)}\r\n"
+        message = (
+            trace_header + message
+            if isinstance(message, str)
+            else trace_header.encode() + message
+        )
+
     smtp_pool = SMTPConnectionPool(host, port, username, password)
+    chunk_size = max_recipients_per_transaction or len(recipients) or 1
+    chunks = [
+        recipients[i : i + chunk_size] for i in range(0, len(recipients), chunk_size)
+    ]
+
+    def send_chunk(index: int, chunk: list[str]) -> dict[str, tuple[int, bytes]] | Exception:
+        chunk_message = message
+        if len(chunks) > 1:
+            # Haraka removes the header and reports the chunk with the delivery statuses.
+            chunk_header = f"X-FM-Chunk: {index}/{len(chunks)}\r\n"
+            chunk_message = (
+                chunk_header + message
+                if isinstance(message, str)
+                else chunk_header.encode() + message
+            )
+
+        try:
+            return send_transaction(smtp_pool, sender, chunk, chunk_message)
+        except (SMTPException, OSError) as e:
+            return e
+
+    if len(chunks) <= 1 or max_parallel_transactions <= 1:
+        results = [send_chunk(index, chunk) for index, chunk in enumerate(chunks, start=1)]
+    else:
+        results = list(
+            transaction_executor.map(send_chunk, range(1, len(chunks) + 1), chunks)
+        )
+
+    errors = [result for result in results if isinstance(result, Exception)]
+    if len(errors) == len(results):
+        # Nothing was accepted, so the message can be redelivered as a whole.
+        raise errors[0]
+
+    # Redelivering would resend the accepted chunks, so the failed ones are reported per recipient.
+    refused = {}
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, Exception):
+            refused.update(dict.fromkeys(chunk, get_error_response(result)))
+        else:
+            refused.update(result)
 
-    try:
-        connection = smtp_pool.get_connection()
-        rate_limiter = get_rate_limiter()
-        connection.sendmail(sender, recipients, message)
-        print(f"Message {outgoing_mail} From `{sender}` To `{recipients}`.")
-        rate_limiter.throttle()
-    finally:
-        if connection:
-            smtp_pool.return_connection(connection)
+    print(f"Message {outgoing_mail} From `{sender}` To `{recipients}`.")
+    for rcpt, (code, response) in refused.items():
+        print(f"Message {outgoing_mail} refused for `{rcpt}`: {code} {response!r}")
+
+    get_rate_limiter().throttle()
+    return refused
@@ -1,12 +1,37 @@
 const dns = require("dns");
 const dsn = require("haraka-dsn");
+require("dotenv").config({ path: __dirname.replace("plugins", ".env") });
+
+const RDNS_CACHE_SIZE = parseInt(process.env.RDNS_CACHE_SIZE || "10000", 10);
+const RDNS_CACHE_TTL_MS = parseInt(process.env.RDNS_CACHE_TTL || "3600", 10) * 1000;
+const RDNS_NEGATIVE_CACHE_TTL_MS =
+    parseInt(process.env.RDNS_NEGATIVE_CACHE_TTL || "300", 10) * 1000;
+const RDNS_STATS_INTERVAL_MS = 5 * 60 * 1000;
+
+// Only definitive answers are cached, resolver failures like timeouts are retried.
+const NEGATIVE_ERROR_CODES = ["ENOTFOUND", "ENODATA"];
 
 exports.register = function () {
     this.loginfo("Registering lookup_rdns hook...");
     this.register_hook("lookup_rdns", "lookup_rdns");
+
+    // Replaceable with a stub that implements `reverse(ip)` and `lookup(host, options)`.
+    this.resolver = dns.promises;
+    this.cache = new Map();
+    this.in_flight = new Map();
+    this.stats = { hits: 0, misses: 0, coalesced: 0 };
+
+    setInterval(
+        () => this.loginfo(`rDNS cache stats: ${JSON.stringify(this.get_stats())}`),
+        RDNS_STATS_INTERVAL_MS
+    ).unref();
 };
 
-exports.lookup_rdns = function (next, connection) {
+exports.get_stats = function () {
+    return { ...this.stats, size: this.cache.size };
+};
+
+exports.lookup_rdns = async function (next, connection) {
     const remote_ip = connection.remote.ip;
 
     if (!remote_ip) {
@@ -18,48 +43,95 @@ exports.lookup_rdns = function (next, connection) {
 
     this.loginfo(`Processing rDNS lookup for IP: ${remote_ip}`);
 
-    // Perform reverse DNS lookup
-    dns.reverse(remote_ip, (err, hostnames) => {
-        if (err) {
-            this.logerror(
-                `DNS reverse lookup failed for IP: ${remote_ip} - Error: ${err.message}`
-            );
-            return next(DENY, dsn.sec_unauthorized(message));
-        }
-
-        if (!hostnames || hostnames.length === 0) {
-            this.logerror(`No PTR record found for IP: ${remote_ip}`);
-            return next(DENY, dsn.sec_unauthorized(message));
-        }
-
-        const remote_host = hostnames[0];
-        this.loginfo(`PTR record found: ${remote_host} for IP: ${remote_ip}`);
-
-        // Perform forward DNS lookup to verify the PTR record
-        dns.lookup(remote_host, { all: true }, (err, addresses) => {
-            if (err) {
-                this.logerror(
-                    `DNS lookup failed for hostname: ${remote_host} - Error: ${err.message}`
-                );
-                return next(DENY, dsn.sec_unauthorized(message));
-            }
+    const result = await this.get_rdns_result(remote_ip);
+    if (result.matched) {
+        this.loginfo(`Forward DNS matches the remote IP: ${remote_ip}`);
+        return next();
+    }
 
-            if (!addresses || addresses.length === 0) {
-                this.logerror(
-                    `No forward DNS entries found for hostname: ${remote_host}`
-                );
-                return next(DENY, dsn.sec_unauthorized(message));
-            }
+    this.logerror(result.reason);
+    return next(DENY, dsn.sec_unauthorized(message));
+};
 
-            const matched = addresses.some((addr) => addr.address === remote_ip);
+exports.get_rdns_result = function (remote_ip) {
+    const cached = this.cache.get(remote_ip);
+    if (cached && cached.expires_at > Date.now()) {
+        // Re-insert to keep the Map ordered from least to most recently used.
+        this.cache.delete(remote_ip);
+        this.cache.set(remote_ip, cached);
+        this.stats.hits++;
+        return Promise.resolve(cached.result);
+    }
 
-            if (matched) {
-                this.loginfo(`Forward DNS matches the remote IP: ${remote_ip}`);
-                return next();
-            } else {
-                this.logerror(`Forward DNS does not match the remote IP: ${remote_ip}`);
-                return next(DENY, dsn.sec_unauthorized(message));
+    // Concurrent connections from the same IP share a single lookup.
+    if (this.in_flight.has(remote_ip)) {
+        this.stats.coalesced++;
+        return this.in_flight.get(remote_ip);
+    }
+
+    this.stats.misses++;
+    const lookup = this.resolve_rdns(remote_ip)
+        .then(({ result, ttl }) => {
+            if (ttl > 0) {
+                this.cache.delete(remote_ip);
+                if (this.cache.size >= RDNS_CACHE_SIZE) {
+                    this.cache.delete(this.cache.keys().next().value);
+                }
+                this.cache.set(remote_ip, { result, expires_at: Date.now() + ttl });
             }
-        });
+            return result;
+        })
+        .finally(() => this.in_flight.delete(remote_ip));
+
+    this.in_flight.set(remote_ip, lookup);
+    return lookup;
+};
+
+exports.resolve_rdns = async function (remote_ip) {
+    const negative = (reason, error) => ({
+        result: { matched: false, reason },
+        ttl:
+            !error || NEGATIVE_ERROR_CODES.includes(error.code)
+                ? RDNS_NEGATIVE_CACHE_TTL_MS
+                : 0,
     });
+
+    // Perform reverse DNS lookup
+    let hostnames;
+    try {
+        hostnames = await this.resolver.reverse(remote_ip);
+    } catch (error) {
+        return negative(
+            `DNS reverse lookup failed for IP: ${remote_ip} - Error: ${error.message}`,
+            error
+        );
+    }
+
+    if (!hostnames || hostnames.length === 0) {
+        return negative(`No PTR record found for IP: ${remote_ip}`);
+    }
+
+    const remote_host = hostnames[0];
+    this.loginfo(`PTR record found: ${remote_host} for IP: ${remote_ip}`);
+
+    // Perform forward DNS lookup to verify the PTR record
+    let addresses;
+    try {
+        addresses = await this.resolver.lookup(remote_host, { all: true });
+    } catch (error) {
+        return negative(
+            `DNS lookup failed for hostname: ${remote_host} - Error: ${error.message}`,
+            error
+        );
+    }
+
+    if (!addresses || addresses.length === 0) {
+        return negative(`No forward DNS entries found for hostname: ${remote_host}`);
+    }
+
+    if (!addresses.some((addr) => addr.address === remote_ip)) {
+        return negative(`Forward DNS does not match the remote IP: ${remote_ip}`);
+    }
+
+    return { result: { matched: true }, ttl: RDNS_CACHE_TTL_MS };
 };
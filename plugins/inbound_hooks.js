@@ -1,13 +1,7 @@
-const os = require("os");
-const fs = require("fs");
-const path = require("path");
-const util = require("util");
 const amqp = require("amqplib");
-const crypto = require("crypto");
 const dsn = require("haraka-dsn");
-const unlink = util.promisify(fs.unlink);
-const readFile = util.promisify(fs.readFile);
 require("dotenv").config({ path: __dirname.replace("plugins", ".env") });
+const { get_queue_options } = require(__dirname.replace("plugins", "lib/queue_options"));
 
 const AGENT_ID = process.env.AGENT_ID;
 const RABBITMQ_HOST = process.env.RABBITMQ_HOST;
@@ -18,12 +12,19 @@ const RABBITMQ_PASSWORD = process.env.RABBITMQ_PASSWORD;
 const RABBITMQ_QUEUE = "mail_agent::incoming_mails";
 const RABBITMQ_URL = `amqp://${RABBITMQ_USERNAME}:${RABBITMQ_PASSWORD}@${RABBITMQ_HOST}:${RABBITMQ_PORT}/${RABBITMQ_VIRTUAL_HOST}`;
 
+// Publishes each message once for all recipients instead of once per recipient.
+// Off by default, as consumers must expand the `x-recipients` header themselves.
+const PUBLISH_ONCE_PER_MESSAGE = process.env.INBOUND_PUBLISH_ONCE_PER_MESSAGE === "1";
+
 exports.register = async function () {
     try {
         this.loginfo("Connecting to RabbitMQ...");
         this.rmq_connection = await amqp.connect(RABBITMQ_URL);
-        this.rmq_channel = await this.rmq_connection.createChannel();
-        await this.rmq_channel.assertQueue(RABBITMQ_QUEUE, { durable: true });
+        this.rmq_channel = await this.rmq_connection.createConfirmChannel();
+        await this.rmq_channel.assertQueue(
+            RABBITMQ_QUEUE,
+            get_queue_options(RABBITMQ_QUEUE, { durable: true })
+        );
         this.loginfo("RabbitMQ connection and channel established.");
     } catch (error) {
         this.logerror(`Failed to connect to RabbitMQ: ${error.message}`);
@@ -43,29 +44,17 @@ exports.hook_queue = function (next, connection, params) {
     }
 
     const transaction = connection.transaction;
-    const message_stream = transaction.message_stream;
-    const tmp_file = path.join(
-        os.tmpdir(),
-        `${generate_random_string(10)}.email`
-    );
+    const received_at_header = `Received-At: ${new Date().toISOString()}\r\n`;
 
-    this.loginfo(`Storing incoming email to temporary file: ${tmp_file}`);
+    this.loginfo("Buffering incoming email in memory.");
 
-    const write_stream = fs.createWriteStream(tmp_file);
-    write_stream.write(`Received-At: ${new Date().toISOString()}\r\n`);
-    message_stream.pipe(write_stream);
-
-    write_stream.on("error", (error) => handle_error(error, this, next));
-    write_stream.on("finish", async () => {
+    transaction.message_stream.get_data(async (data) => {
         try {
-            const content = await readFile(tmp_file);
-            await process_recipients(transaction, content, this);
+            const content = Buffer.concat([Buffer.from(received_at_header), data]);
+            await publish_message(transaction, content, this);
             next(OK, "Delivered");
         } catch (error) {
             handle_error(error, this, next);
-        } finally {
-            write_stream.close();
-            await try_delete_file(tmp_file, this);
         }
     });
 };
@@ -75,49 +64,54 @@ function handle_error(error, context, next) {
     return next(DENY, dsn.sys_unspecified("Internal Server Error"));
 }
 
-async function process_recipients(transaction, content, context) {
-    const rcpts = transaction.rcpt_to;
-    for (const rcpt of rcpts) {
-        const delivered_to_header = `Delivered-To: ${rcpt.user}@${rcpt.host}\r\n`;
-        const content_with_header = delivered_to_header + content;
-        try {
-            context.loginfo(
-                `Sending message to RabbitMQ for recipient: ${rcpt.user}@${rcpt.host}`
-            );
-            await context.rmq_channel.sendToQueue(
-                RABBITMQ_QUEUE,
-                Buffer.from(content_with_header),
-                {
-                    persistent: true,
-                    appId: AGENT_ID,
-                }
-            );
-        } catch (error) {
-            context.logerror(
-                `Failed to send message to RabbitMQ for ${rcpt.user}@${rcpt.host}: ${error.message}`
-            );
-            throw error;
-        }
-    }
-}
+function publish_message(transaction, content, context) {
+    const recipients = transaction.rcpt_to.map((rcpt) => `${rcpt.user}@${rcpt.host}`);
 
-async function try_delete_file(file, context) {
-    try {
-        await unlink(file);
-        context.loginfo(`Temporary file deleted: ${file}`);
-    } catch (error) {
-        context.logerror(
-            `Failed to delete temporary file: ${file} - Error: ${error.message}`
+    if (PUBLISH_ONCE_PER_MESSAGE) {
+        // Consumers prepend the `Delivered-To` header per recipient from the `x-recipients` header.
+        context.loginfo(
+            `Sending message to RabbitMQ for recipients: ${recipients.join(", ")}`
         );
+        return send_to_queue(context, content, recipients, {
+            "x-recipients": recipients,
+        });
     }
+
+    // The broker confirms the publishes of all recipients in batches.
+    return Promise.all(
+        recipients.map((recipient) => {
+            context.loginfo(`Sending message to RabbitMQ for recipient: ${recipient}`);
+            const delivered_to_header = Buffer.from(`Delivered-To: ${recipient}\r\n`);
+            return send_to_queue(
+                context,
+                Buffer.concat([delivered_to_header, content]),
+                [recipient]
+            );
+        })
+    );
 }
 
-function generate_random_string(length) {
-    return crypto
-        .randomBytes(Math.ceil(length / 2))
-        .toString("hex")
-        .slice(0, length)
-        .toUpperCase();
+function send_to_queue(context, content, recipients, headers = {}) {
+    return new Promise((resolve, reject) => {
+        context.rmq_channel.sendToQueue(
+            RABBITMQ_QUEUE,
+            content,
+            {
+                persistent: true,
+                appId: AGENT_ID,
+                headers: headers,
+            },
+            (error) => {
+                if (error) {
+                    context.logerror(
+                        `Failed to send message to RabbitMQ for ${recipients.join(", ")}: ${error.message}`
+                    );
+                    return reject(error);
+                }
+                resolve();
+            }
+        );
+    });
 }
 
 exports.shutdown = async function () {
@@ -1,14 +1,88 @@
+const fs = require("fs");
+const net = require("net");
 const axios = require("axios");
 const dsn = require("haraka-dsn");
 require("dotenv").config({ path: __dirname.replace("plugins", ".env") });
 
 const FRAPPE_BLACKLIST_HOST = process.env.FRAPPE_BLACKLIST_HOST;
+const SNAPSHOT_PATH =
+    process.env.BLACKLIST_SNAPSHOT_PATH ||
+    __dirname.replace("plugins", "blacklist.snapshot");
+const SNAPSHOT_MAX_AGE_MS =
+    parseInt(process.env.BLACKLIST_SNAPSHOT_MAX_AGE || "900", 10) * 1000;
+const CACHE_TTL_MS = parseInt(process.env.BLACKLIST_CACHE_TTL || "300", 10) * 1000;
+const CACHE_MAX_SIZE = 10000;
+
+// Written by `mail-agent sync-blacklist`, see mail_agent/blacklist.py for the format.
+const SNAPSHOT_MAGIC = "MABL";
+const SNAPSHOT_HEADER_SIZE = 18;
+const SNAPSHOT_RECORD_SIZE = 32;
+const SNAPSHOT_RELOAD_INTERVAL_MS = 10000;
+
+exports.register = function () {
+    this.snapshot = null;
+    this.cache = new Map();
+    this.load_snapshot();
+    setInterval(() => this.load_snapshot(), SNAPSHOT_RELOAD_INTERVAL_MS).unref();
+};
+
+exports.load_snapshot = function () {
+    try {
+        const stat = fs.statSync(SNAPSHOT_PATH);
+        if (this.snapshot && this.snapshot.mtime === stat.mtimeMs) {
+            return;
+        }
+
+        const data = fs.readFileSync(SNAPSHOT_PATH);
+        if (data.toString("latin1", 0, 4) !== SNAPSHOT_MAGIC) {
+            throw new Error("Invalid snapshot format");
+        }
+
+        this.snapshot = {
+            data: data,
+            mtime: stat.mtimeMs,
+            generated_at: data.readDoubleBE(6) * 1000,
+            count: data.readUInt32BE(14),
+        };
+        this.loginfo(`Loaded blacklist snapshot with ${this.snapshot.count} ranges.`);
+    } catch (error) {
+        if (error.code !== "ENOENT") {
+            this.logerror(`Failed to load blacklist snapshot: ${error.message}`);
+        }
+    }
+};
 
 exports.hook_connect = async function (next, connection) {
     const remote_ip = connection.remote.ip;
 
     this.loginfo(`Checking blacklist status for IP: ${remote_ip}`);
 
+    let is_blacklisted;
+    if (this.snapshot && Date.now() - this.snapshot.generated_at <= SNAPSHOT_MAX_AGE_MS) {
+        is_blacklisted = is_in_snapshot(this.snapshot, ip_to_buffer(remote_ip));
+    } else {
+        this.logwarn("Blacklist snapshot is missing or stale, querying the blacklist API.");
+        is_blacklisted = await this.query_blacklist(remote_ip);
+    }
+
+    if (is_blacklisted) {
+        this.logwarn(`IP address ${remote_ip} is blacklisted.`);
+
+        const message = `Connection denied. Your IP address (${remote_ip}) is listed on our blacklist. This could be due to suspected malicious activity or a history of spam. If you believe this is an error, please contact our support team for further assistance.`;
+
+        return next(DENY, dsn.sec_unauthorized(message));
+    }
+
+    this.loginfo(`IP address ${remote_ip} is not blacklisted.`);
+    return next();
+};
+
+exports.query_blacklist = async function (remote_ip) {
+    const cached = this.cache.get(remote_ip);
+    if (cached && cached.expires_at > Date.now()) {
+        return cached.is_blacklisted;
+    }
+
     try {
         const response = await axios.get(
             `${FRAPPE_BLACKLIST_HOST}/api/method/mail.api.blacklist.get`,
@@ -20,21 +94,20 @@ exports.hook_connect = async function (next, connection) {
 
         const data = response.data;
         if (data && data.message) {
-            const result = data.message;
-            if (result && result.is_blacklisted) {
-                this.logwarn(`IP address ${remote_ip} is blacklisted.`);
-                
-                const message = `Connection denied. Your IP address (${remote_ip}) is listed on our blacklist. This could be due to suspected malicious activity or a history of spam. If you believe this is an error, please contact our support team for further assistance.`;
-                
-                return next(DENY, dsn.sec_unauthorized(message));
-            } else {
-                this.loginfo(`IP address ${remote_ip} is not blacklisted.`);
+            const is_blacklisted = Boolean(data.message.is_blacklisted);
+            if (this.cache.size >= CACHE_MAX_SIZE) {
+                this.cache.delete(this.cache.keys().next().value);
             }
-        } else {
-            this.logerror(
-                `Unexpected response format from blacklist API for IP: ${remote_ip}`
-            );
+            this.cache.set(remote_ip, {
+                is_blacklisted: is_blacklisted,
+                expires_at: Date.now() + CACHE_TTL_MS,
+            });
+            return is_blacklisted;
         }
+
+        this.logerror(
+            `Unexpected response format from blacklist API for IP: ${remote_ip}`
+        );
     } catch (error) {
         if (error.code === "ECONNABORTED") {
             this.logerror(
@@ -47,5 +120,63 @@ exports.hook_connect = async function (next, connection) {
         }
     }
 
-    return next();
+    return false;
 };
+
+function is_in_snapshot(snapshot, ip) {
+    if (!ip) {
+        return false;
+    }
+
+    // Binary search for the last range that starts at or before the IP.
+    let low = 0;
+    let high = snapshot.count - 1;
+    let index = -1;
+    while (low <= high) {
+        const mid = (low + high) >>> 1;
+        const offset = SNAPSHOT_HEADER_SIZE + mid * SNAPSHOT_RECORD_SIZE;
+        if (ip.compare(snapshot.data, offset, offset + 16) >= 0) {
+            index = mid;
+            low = mid + 1;
+        } else {
+            high = mid - 1;
+        }
+    }
+
+    if (index < 0) {
+        return false;
+    }
+
+    const offset = SNAPSHOT_HEADER_SIZE + index * SNAPSHOT_RECORD_SIZE + 16;
+    return ip.compare(snapshot.data, offset, offset + 16) <= 0;
+}
+
+function ip_to_buffer(ip) {
+    const buffer = Buffer.alloc(16);
+
+    if (ip.toLowerCase().startsWith("::ffff:") && net.isIPv4(ip.slice(7))) {
+        ip = ip.slice(7);
+    }
+
+    if (net.isIPv4(ip)) {
+        buffer.writeUInt16BE(0xffff, 10);
+        ip.split(".").forEach((octet, i) => (buffer[12 + i] = parseInt(octet, 10)));
+        return buffer;
+    }
+
+    if (!net.isIPv6(ip)) {
+        return null;
+    }
+
+    const [head, tail] = ip.split("::");
+    const head_groups = head ? head.split(":") : [];
+    const tail_groups = tail ? tail.split(":") : [];
+    const groups = [
+        ...head_groups,
+        ...Array(8 - head_groups.length - tail_groups.length).fill("0"),
+        ...tail_groups,
+    ];
+    groups.forEach((group, i) => buffer.writeUInt16BE(parseInt(group, 16), i * 2));
+
+    return buffer;
+}
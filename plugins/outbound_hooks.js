@@ -1,5 +1,6 @@
 const amqp = require("amqplib");
 require("dotenv").config({ path: __dirname.replace("plugins", ".env") });
+const { get_queue_options } = require(__dirname.replace("plugins", "lib/queue_options"));
 
 const AGENT_ID = process.env.AGENT_ID;
 const RABBITMQ_HOST = process.env.RABBITMQ_HOST;
@@ -10,15 +11,35 @@ const RABBITMQ_PASSWORD = process.env.RABBITMQ_PASSWORD;
 const RABBITMQ_QUEUE = "mail_agent::outgoing_mails_status";
 const RABBITMQ_URL = `amqp://${RABBITMQ_USERNAME}:${RABBITMQ_PASSWORD}@${RABBITMQ_HOST}:${RABBITMQ_PORT}/${RABBITMQ_VIRTUAL_HOST}`;
 
+// Delivery statuses are published in batches of up to STATUS_BATCH_SIZE events,
+// flushed at least every STATUS_BATCH_INTERVAL_MS. A batch size of 1 disables batching.
+const STATUS_BATCH_SIZE = parseInt(process.env.STATUS_BATCH_SIZE || "1", 10);
+const STATUS_BATCH_INTERVAL_MS = parseInt(
+    process.env.STATUS_BATCH_INTERVAL_MS || "1000",
+    10
+);
+// Events waiting for a batch, including failed ones being retried, are capped at
+// STATUS_BATCH_MAX_PENDING so that a broker outage cannot grow the buffer without limit.
+const STATUS_BATCH_MAX_PENDING = parseInt(
+    process.env.STATUS_BATCH_MAX_PENDING || "10000",
+    10
+);
+const status_batch = [];
+let status_batch_timer = null;
+let status_flush = null;
+
 exports.register = async function () {
     try {
         this.loginfo("Connecting to RabbitMQ...");
         this.rmq_connection = await amqp.connect(RABBITMQ_URL);
-        this.rmq_channel = await this.rmq_connection.createChannel();
-        await this.rmq_channel.assertQueue(RABBITMQ_QUEUE, {
-            durable: true,
-            arguments: { "x-max-priority": 3 },
-        });
+        this.rmq_channel = await this.rmq_connection.createConfirmChannel();
+        await this.rmq_channel.assertQueue(
+            RABBITMQ_QUEUE,
+            get_queue_options(RABBITMQ_QUEUE, {
+                durable: true,
+                arguments: { "x-max-priority": 3 },
+            })
+        );
         this.loginfo("RabbitMQ connection and channel established.");
     } catch (error) {
         this.logerror(`Failed to connect to RabbitMQ: ${error.message}`);
@@ -26,6 +47,33 @@ exports.register = async function () {
     }
 };
 
+exports.hook_data_post = function (next, connection) {
+    if (!connection.relaying) {
+        return next(); // Skip for inbound
+    }
+
+    try {
+        // Stage timestamps stamped by the Mail Agent worker, not meant for the recipient.
+        const trace_header = connection.transaction.header.get("X-FM-Trace");
+        if (trace_header) {
+            connection.transaction.notes.trace = parse_trace(trace_header);
+            connection.transaction.remove_header("X-FM-Trace");
+        }
+
+        // Set when the worker split the recipients of the outgoing mail into several transactions.
+        const chunk_header = connection.transaction.header.get("X-FM-Chunk");
+        if (chunk_header) {
+            const [index, count] = chunk_header.trim().split("/").map(Number);
+            connection.transaction.notes.chunk = { index, count };
+            connection.transaction.remove_header("X-FM-Chunk");
+        }
+    } catch (error) {
+        this.logerror(`Error processing hook_data_post: ${error.message}`);
+    }
+
+    return next();
+};
+
 exports.hook_queue_ok = async function (next, connection) {
     if (!connection.relaying) {
         return next(); // Skip for inbound
@@ -37,13 +85,21 @@ exports.hook_queue_ok = async function (next, connection) {
             .get("X-FM-OM")
             .replace(/(\r\n|\n|\r)/gm, "");
 
+        const trace = {
+            ...connection.transaction.notes.trace,
+            queued_at: Date.now() / 1000,
+        };
+
         connection.transaction.notes.queue_id = queue_id;
         connection.transaction.notes.outgoing_mail = outgoing_mail;
+        connection.transaction.notes.trace = trace;
 
         const data = {
             hook: "queue_ok",
             queue_id: queue_id,
             outgoing_mail: outgoing_mail,
+            chunk: connection.transaction.notes.chunk,
+            trace: trace,
         };
 
         await enqueue_delivery_status(this.rmq_channel, data);
@@ -67,6 +123,7 @@ exports.hook_deferred = async function (next, hmail, params) {
             queue_id: queue_id,
             retries: hmail.num_failures - 1,
             outgoing_mail: outgoing_mail,
+            chunk: hmail.notes.chunk,
             action_at: new Date().toISOString(),
         };
 
@@ -98,6 +155,7 @@ exports.hook_bounce = async function (next, hmail, error) {
             queue_id: queue_id,
             retries: hmail.num_failures,
             outgoing_mail: outgoing_mail,
+            chunk: hmail.notes.chunk,
             action_at: new Date().toISOString(),
         };
 
@@ -121,7 +179,9 @@ exports.hook_delivered = async function (next, hmail, params) {
             queue_id: queue_id,
             retries: hmail.num_failures,
             outgoing_mail: outgoing_mail,
+            chunk: hmail.notes.chunk,
             action_at: new Date().toISOString(),
+            trace: { ...hmail.notes.trace, delivered_at: Date.now() / 1000 },
         };
 
         await enqueue_delivery_status(this.rmq_channel, data);
@@ -133,25 +193,112 @@ exports.hook_delivered = async function (next, hmail, params) {
     return next();
 };
 
+function parse_trace(header) {
+    const trace = {};
+    for (const part of header.replace(/(\r\n|\n|\r)/gm, "").split(";")) {
+        const [stage, timestamp] = part.split("=").map((value) => value.trim());
+        if (stage && !isNaN(parseFloat(timestamp))) {
+            trace[stage] = parseFloat(timestamp);
+        }
+    }
+    return trace;
+}
+
 async function enqueue_delivery_status(channel, data) {
-    try {
-        await channel.sendToQueue(
+    if (STATUS_BATCH_SIZE <= 1) {
+        return publish_delivery_status(channel, JSON.stringify(data));
+    }
+
+    status_batch.push(data);
+    if (status_batch.length >= STATUS_BATCH_SIZE) {
+        return flush_delivery_status(channel);
+    }
+
+    schedule_flush(channel);
+}
+
+function schedule_flush(channel) {
+    if (!status_batch_timer) {
+        status_batch_timer = setTimeout(
+            () => flush_delivery_status(channel).catch(() => {}),
+            STATUS_BATCH_INTERVAL_MS
+        );
+    }
+}
+
+// A flush in progress keeps publishing until the buffer is empty, so concurrent
+// flushes join it instead of splicing the buffer at the same time.
+function flush_delivery_status(channel) {
+    if (!status_flush) {
+        status_flush = publish_status_batches(channel).finally(() => {
+            status_flush = null;
+        });
+    }
+    return status_flush;
+}
+
+async function publish_status_batches(channel) {
+    clearTimeout(status_batch_timer);
+    status_batch_timer = null;
+
+    while (status_batch.length > 0) {
+        const batch = status_batch.splice(0, STATUS_BATCH_SIZE);
+        try {
+            await publish_delivery_status(channel, JSON.stringify(batch), {
+                "x-batch-size": batch.length,
+            });
+        } catch (error) {
+            status_batch.unshift(...batch);
+            if (status_batch.length > STATUS_BATCH_MAX_PENDING) {
+                const dropped = status_batch.splice(
+                    0,
+                    status_batch.length - STATUS_BATCH_MAX_PENDING
+                );
+                console.error(
+                    `Dropped ${dropped.length} oldest delivery status events, the batch buffer is full.`
+                );
+            }
+            schedule_flush(channel); // Retried after the interval.
+            throw error;
+        }
+    }
+}
+
+function publish_delivery_status(channel, content, headers = {}) {
+    return new Promise((resolve, reject) => {
+        channel.sendToQueue(
             RABBITMQ_QUEUE,
-            Buffer.from(JSON.stringify(data)),
+            Buffer.from(content),
             {
                 persistent: true,
                 appId: AGENT_ID,
+                headers: headers,
+                timestamp: Math.floor(Date.now() / 1000),
+            },
+            (error) => {
+                if (error) {
+                    console.error(
+                        `Error enqueueing delivery status: ${error.message}`
+                    );
+                    return reject(error);
+                }
+                resolve();
             }
         );
-    } catch (error) {
-        console.error(`Error enqueueing delivery status: ${error.message}`);
-        throw error;
-    }
+    });
 }
 
 exports.shutdown = async function () {
     try {
         if (this.rmq_channel) {
+            try {
+                await flush_delivery_status(this.rmq_channel);
+            } catch (error) {
+                this.logerror(
+                    `Failed to flush ${status_batch.length} delivery status events: ${error.message}`
+                );
+            }
+            clearTimeout(status_batch_timer);
             await this.rmq_channel.close();
             this.loginfo("RabbitMQ channel closed.");
         }